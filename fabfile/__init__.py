@@ -30,6 +30,12 @@ except ImportError:
 
 from util import *
 
+# Pool keepalive'd gateway connections, shared across hosts and threads (see `gateway_*` below)
+import monkeypatch_sshproxy
+
+# Time each task and step, reporting where a deploy spent its time on exit (see `timings_*` below)
+import timing
+
 
 
 ### Fabric Config
@@ -45,14 +51,106 @@ defaults(env, dict(
     git_origin         = 'git://github.com/wikimedia/limn.git',
     dev_server         = 'localhost:8081',
     minify_cmd         = 'uglifyjs',
+    # Minifies one app module; `{src}`, `{out}` and `{map}` are filled in per module
+    minify_module_cmd  = '%(minify_cmd)s {src} -o {out} --source-map {map}',
+    # Processes minifying app modules in parallel (None: one per core)
+    minify_workers     = None,
+    
+    # Identifies the sources and node_modules the derived files in var/ were built from
+    build_fingerprint     = '%(target_dir)s/var/.build-fingerprint',
+    
+    # Release deploys (`deploy.release`): each release is built in its own directory, started on
+    # whichever of `release_ports` (ex: '8091:8092'; not the provider job's own port) is idle, and cut over
+    # to once healthy by running `proxy_switch_cmd` (required).
+    releases_dir          = '%(target_dir)s-releases',
+    # Per provider job, as stages sharing a `target_dir` share `releases_dir` but not servers
+    current_link          = '%(releases_dir)s/current-%(provider_job)s',
+    release_ports         = None,
+    # Each port's server runs as this job of `provider` (upstart or supervisor), whose definition
+    # is installed on the host, so the live release is respawned and comes back at boot
+    release_job           = '%(provider_job)s-release-{port}',
+    release_server_cmd    = 'coke -v %(target_var_dir)s -p {port} server',
+    health_url            = 'http://localhost:{port}/',
+    release_ready_timeout = 60,
+    proxy_switch_cmd      = None,
+    # Build releases locally and ship them to the host as tarballs from the artifact store,
+    # rather than building on the host.
+    release_build_locally = False,
+    artifacts_keep        = 10,
+    # Releases retained on the host for `deploy.rollback`
+    releases_keep         = 5,
+    
+    # Gateway connections: how many to pool, keepalive interval (seconds), and optionally an OpenSSH
+    # ControlMaster socket to tunnel through so successive runs reuse one authenticated session
+    gateway_pool_size       = 1,
+    gateway_keepalive       = 30,
+    gateway_control_path    = None,
+    gateway_control_persist = '10m',
+    
+    # Data repositories are cloned with only `git_data_branch`, `git_data_depth` commits deep
+    # (None: full history) and, if set, a partial clone filter (ex: 'blob:none'). `git_data_gc`
+    # is 'auto', 'prune' (drop unreachable history on every deploy) or 'never'.
+    git_data_depth          = None,
+    git_data_filter         = None,
+    git_data_gc             = 'auto',
+    
+    # Per-stage index of the data files (blob hash and link), so data deploys only touch the links that changed
+    data_index              = '%(target_var_dir)s/.data-index-%(target_data_to)s',
+    
+    # Data deploys POST the paths of changed data files (one per line) here, with `?to=<target_data_to>`,
+    # so the server can drop them from its caches (ex: 'http://localhost:8081/_data/changed')
+    data_reload_url         = None,
+    
+    # Jobs restarted together (ex: by a multi-stage deploy) are restarted one at a time,
+    # each waiting for the last to be running again
+    rolling_restarts        = True,
+    
+    # Print the steps `deploy` would run instead of running them
+    dry_run            = False,
+    
+    # 'incremental' fixes only paths with the wrong owner/mode; 'recursive' rewrites the whole tree
+    permissions_mode   = 'incremental',
+    
+    # Per-step timings are printed when fab exits (unless `timings_report` is off) and saved
+    # as JSON in `timings_dir` (unless empty), plus a chrome://tracing file if `timings_trace` is on
+    timings_report     = True,
+    timings_dir        = '%(local_tmp)s/timings',
+    timings_trace      = False,
+    
+    # Number of stages deployed concurrently by `deploy.stages` / `deploy.all_stages`
+    stage_workers      = 4,
     
     ### Paths
     dist               = 'dist',
     local_tmp          = 'tmp',
     work_dir           = '%(local_tmp)s/%(dist)s',
     
+    # Caches persisting between deploys, keyed by content hash
+    local_cache_dir    = '~/.cache/limn-deploy',
+    git_mirror         = '%(local_cache_dir)s/limn.git',
+    deps_cache_dir     = '%(local_cache_dir)s/node_modules',
+    minify_cache_dir   = '%(local_cache_dir)s/minified',
+    browserify_cache_dir = '%(local_cache_dir)s/browserify',
+    artifacts_dir      = '%(local_cache_dir)s/artifacts',
+    target_deps_dir    = '%(target_dir)s-deps',
+    # Unused dependency installs kept on the host, and in `deps_cache_dir` locally
+    deps_cache_keep    = 3,
+    # How new dependency installs reach the host: 'rsync' the changes against the install already
+    # there, send a 'tar' stream of the whole tree, or 'auto'matically rsync if at least
+    # `deps_delta_threshold` of the files are unchanged
+    deps_transfer        = 'auto',
+    deps_delta_threshold = 0.5,
+    
     browserify_js      = 'vendor/browserify.js',
     work_browserify_js = '%(work_dir)s/%(browserify_js)s',
+    # browserify.js is cached by the versions of browserify and these modules. On a miss it is
+    # fetched from the dev server, or generated by `browserify_cmd` if set
+    # (ex: 'browserify -o {out} {modules}').
+    browserify_modules = ['events', 'seq'],
+    browserify_cmd     = None,
+    
+    # Hard-link unchanged files into the work dir rather than copying them
+    collapse_link      = False,
     
     vendor_search_dirs = ['static', 'var', '%(work_dir)s'],
     vendor_bundle      = '%(work_dir)s/vendor/vendor-bundle.min.js',
@@ -60,13 +158,15 @@ defaults(env, dict(
 ))
 
 env_paths = (
-    'dist', 'local_tmp', 'work_dir', 
+    'dist', 'local_tmp', 'work_dir', 'local_cache_dir', 'git_mirror', 'deps_cache_dir', 'minify_cache_dir',
+    'browserify_cache_dir', 'artifacts_dir',
     'browserify_js', 'work_browserify_js',
     'vendor_bundle', 'app_bundle',
 )
 for k in env_paths:
     env[k] = p(env[k])
 
+env.local_cache_dir    = env.local_cache_dir.expanduser()
 env.vendor_search_dirs = [ expand(p(vd)) for vd in env.vendor_search_dirs ]
 env.app_bundle_min     = p(env.app_bundle.replace('.js', '.min.js'))
 
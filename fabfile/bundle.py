@@ -2,12 +2,19 @@
 # -*- coding: utf-8 -*-
 "Deploy Bundle Tasks"
 
+import hashlib, json, multiprocessing, os, re, shutil, subprocess
+from contextlib import contextmanager
+
 from fabric.api import *
 from fabric.colors import white, blue, cyan, green, yellow, red, magenta
+from path import path as p # renamed to avoid conflict w/ fabric.api.path
 
 from util import *
 
 
+CHUNK_SIZE = 1 << 16
+
+
 @task(default=True)
 @expand_env
 def bundle_all():
@@ -26,28 +33,68 @@ def collapse_trees():
     """
     update_version()
     
-    # Ensure clean dist directory
-    env.work_dir.rmtree(ignore_errors=True)
-    env.work_dir.makedirs()
+    # The dist directory is kept between runs and synced, so rsync only copies what changed
+    env.work_dir.makedirs_p()
     
     # XXX: Unfortunately, we can't use rsync_project() for local-to-local copies, as it insists on
     # inserting a : before the remote path, which indicates a local-to-remote copy. :(
     
     # Copy the static files, derived files, along with the data directory
     # into dist. Note that you will need to load all the site pages in your browser to populate var
-    # with the derived files.
-    local('rsync -Ca static/ var/ %(work_dir)s/' % env)
+    # with the derived files. Files we generate into dist are protected from --delete.
+    generated = [ env.work_browserify_js, env.vendor_bundle, env.app_bundle, env.app_bundle_min ]
+    protect = ' '.join( "--filter='P /%s*'" % env.work_dir.relpathto(f) for f in generated )
+    stats = collapse('static/ var/', env.work_dir, "--filter='P /src/' " + protect)
     
     # We copy src (which contains .co source files) to src to make it easy to link source content
     # to each other. Finding it in gitweb is a pain. Finding it in gerrit is almost impossible.
     # But this could go away when we move to github.
-    local('rsync -Ca src/ %(work_dir)s/src/' % env)
+    stats = [ a+b for a, b in zip(stats, collapse('src/', env.work_dir/'src')) ]
+    puts(cyan('Copied %s files (%s bytes) into %s.' % (stats[0], stats[1], env.work_dir)))
+    
+    cached = cache_browserify()
+    if env.work_browserify_js.exists() and env.work_browserify_js.bytes() == cached.bytes():
+        return
+    with atomic_write(env.work_browserify_js) as f:
+        with cached.open('rb') as src:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+
+@task
+@expand_env
+def cache_browserify():
+    """ Ensures browserify.js for the installed browserify and modules is cached, returning the cached file.
+    """
+    modules = env.browserify_modules
+    if isinstance(modules, basestring):
+        modules = modules.split(',')
+    versions = [ '%s@%s' % (mod, module_version(mod)) for mod in ['browserify'] + list(modules) ]
+    cached = env.browserify_cache_dir/hashlib.sha1(' '.join(versions)).hexdigest()[:16] + '.js'
+    if cached.exists():
+        return cached
     
+    env.browserify_cache_dir.makedirs_p()
+    tmp = p(cached + '.tmp')
     # For some reason, the shell tool does not generate a file identical to the middleware. So whatever.
-    # We curl here because we know that version works.
-    # local('browserify -o %(work_dir)s/%(browserify_js)s -r events -r seq' % env)
-    with env.work_browserify_js.open('w') as f:
-        f.write( local('curl --silent --fail --url http://%(dev_server)s/%(browserify_js)s' % env, capture=True) )
+    # We curl here because we know that version works, but only once per set of module versions.
+    with settings(warn_only=True):
+        fetched = local('curl --silent --fail --output %s --url http://%s/%s' % (tmp, env.dev_server, env.browserify_js))
+    if fetched.failed:
+        if not env.browserify_cmd:
+            abort(red(('No cached browserify.js for %s, and no dev server at %s to fetch it from! '
+                       'Start one once (or set browserify_cmd) to fill the cache.') % (', '.join(versions), env.dev_server), bold=True))
+        puts(yellow('Dev server unavailable; generating browserify.js with %(browserify_cmd)r.' % env))
+        with path('node_modules/.bin'):
+            local(env.browserify_cmd.format(out=tmp, modules=' '.join( '-r %s' % mod for mod in modules )))
+    os.rename(tmp, cached)
+    puts(cyan('Cached browserify.js for %s.' % ', '.join(versions)))
+    return cached
+
+def module_version(name):
+    "Version of the npm module `name` installed in node_modules, or 'builtin' for Node core modules browserify shims."
+    try:
+        return json.loads(p('node_modules/%s/package.json' % name).text())['version']
+    except (IOError, OSError):
+        return 'builtin'
 
 @task
 @expand_env
@@ -56,19 +103,26 @@ def bundle_vendor():
     """ Bundles vendor files.
     """
     update_version()
-    with env.vendor_bundle.open('w') as vendor_bundle:
-        
-        for js in local('coke list_all | grep vendor', capture=True).split('\n'):
-            try:
-                # Search for matching vendor file as it might be derived (.mod.js)
-                vendor_file = ( d/js for d in env.vendor_search_dirs if (d/js).exists() ).next()
-            except StopIteration:
-                abort("Unable to locate vendor file '%s'!" % js)
+    sources = local('coke list_all | grep vendor', capture=True).split('\n')
+    index   = source_index(env.vendor_search_dirs, sources)
+    missing = [ js for js in sources if js not in index ]
+    if missing:
+        abort("Unable to locate vendor file '%s'!" % missing[0])
+    
+    manifest_file = p(env.vendor_bundle + '.manifest.json')
+    old = read_manifest(manifest_file)
+    manifest = [ file_entry(js, index[js], old.get(js)) for js in sources ]
+    if env.vendor_bundle.exists() and old.get('inputs') == manifest:
+        puts(cyan('Vendor files unchanged; reusing %(vendor_bundle)s.' % env))
+        return
+    
+    with atomic_write(env.vendor_bundle) as vendor_bundle:
+        for js in sources:
             vendor_bundle.write("\n;\n")
-            with vendor_file.open() as f:
-                vendor_bundle.write(f.read())
-        
+            with index[js].open('rb') as f:
+                shutil.copyfileobj(f, vendor_bundle, CHUNK_SIZE)
         vendor_bundle.write('\n')
+    write_manifest(manifest_file, manifest)
 
 @task
 @expand_env
@@ -77,11 +131,179 @@ def bundle_app():
     """ Bundles and minifies app files.
     """
     update_version()
-    # XXX: Meh. Maybe this should become python code.
-    local('cat $(coke source_list | grep -v vendor | sed "s/^/var\//") > %(app_bundle)s' % env)
-    # Run the minify command, adding npm's bin directory
-    with path('node_modules/.bin'):
-        local('%(minify_cmd)s %(app_bundle)s > %(app_bundle_min)s' % env)
+    sources = [ p('var')/src for src in local('coke source_list | grep -v vendor', capture=True).split('\n') if src ]
+    
+    with atomic_write(env.app_bundle) as app_bundle:
+        for src in sources:
+            with src.open('rb') as f:
+                shutil.copyfileobj(f, app_bundle, CHUNK_SIZE)
+    
+    # Each module is minified separately so only changed ones need it again, and those in parallel
+    minified = minify_all(sources, env.minify_module_cmd, env.minify_cache_dir, env.minify_workers)
+    
+    sections = []
+    line = 0
+    map_file = p(env.app_bundle_min + '.map')
+    with atomic_write(env.app_bundle_min) as bundle_min:
+        for js, source_map in minified:
+            bundle_min.write("\n;\n")
+            line += 2
+            if source_map is not None:
+                sections.append({ 'offset':{ 'line':line, 'column':0 }, 'map':json.loads(source_map.text()) })
+            with js.open('rb') as f:
+                contents = strip_source_map_url(f.read())
+            bundle_min.write(contents)
+            line += contents.count('\n')
+        bundle_min.write('\n//# sourceMappingURL=%s\n' % map_file.name)
+    
+    with atomic_write(map_file) as f:
+        json.dump({ 'version':3, 'file':env.app_bundle_min.name, 'sections':sections }, f)
+
+
+def strip_source_map_url(js):
+    """ Removes the trailing `//# sourceMappingURL=` comment the minifier gives each module, which names
+        its map in the local cache; the bundle ends with a single one naming the combined map.
+    """
+    return SOURCE_MAP_URL.sub('', js)
 
+SOURCE_MAP_URL = re.compile(r'\n?//[#@] sourceMappingURL=[^\n]*\s*$')
+
+
+### Bundling Helpers
+
+def collapse(sources, dest, opts=''):
+    """ Syncs the (space-separated, trailing-slashed) `sources` into `dest`, deleting files that
+        are in none of them, and returns the number of files and bytes actually copied.
+        
+        With `env.collapse_link`, unchanged files are hard-linked from the sources instead of copied.
+        This is safe because everything generated into dist is written to a new file and renamed.
+    """
+    if truthy(env.collapse_link):
+        opts += ' ' + ' '.join( '--link-dest=%s' % p(src).abspath() for src in sources.split() )
+    out = local('rsync -Ca --delete --stats %s %s %s/' % (opts, sources, dest), capture=True)
+    return rsync_stats(out)
+
+def rsync_stats(output):
+    "Number of files and bytes transferred, according to `rsync --stats` output."
+    def stat(pattern):
+        match = re.search(pattern + r':\s*([\d,]+)', output)
+        return int(match.group(1).replace(',', '')) if match else 0
+    return stat(r'Number of (?:regular )?files transferred'), stat(r'Total transferred file size')
+
+def source_index(search_dirs, sources):
+    """ Maps each of the relative paths `sources` to the file it names in the first of `search_dirs`
+        that has it, walking each directory once rather than probing every path in every directory.
+        Only the top-level subdirectories the sources live in are walked.
+    """
+    tops  = set( src.split('/', 1)[0] for src in sources )
+    index = {}
+    for d in search_dirs:
+        for top in tops:
+            if (d/top).isfile():
+                index.setdefault(top, d/top)
+            elif (d/top).isdir():
+                for f in (d/top).walkfiles():
+                    index.setdefault(str(d.relpathto(f)), f)
+    return index
+
+def file_entry(name, f, prev=None):
+    """ Manifest entry for the bundle input `name` found at `f`. Its content hash is
+        carried over from the previous entry if the file's size and mtime are unchanged.
+    """
+    st = f.stat()
+    entry = dict(name=name, file=str(f), size=st.st_size, mtime=st.st_mtime)
+    if prev and all( prev.get(k) == entry[k] for k in ('file', 'size', 'mtime') ):
+        entry['sha1'] = prev['sha1']
+    else:
+        entry['sha1'] = file_digest(f)
+    return entry
+
+class MinifyError(Exception):
+    "Exception thrown when the minify command fails on a module."
+
+def minify_all(sources, cmd, cache_dir, workers=None):
+    """ Minifies each of `sources` (see `minify_file()`), farming the modules not
+        already cached out to a pool of `workers` processes (default: one per core).
+        Returns the (minified file, source map) pairs in the order of `sources`.
+    """
+    jobs = [ (src, cmd, cache_dir) for src in sources ]
+    misses = [ job for job in jobs if not minified_paths(*job)[0].exists() ]
+    if len(misses) > 1:
+        pool = multiprocessing.Pool(int(workers) if workers else None)
+        try:
+            failures = [ err for err in pool.map(_minify_job, misses) if err ]
+        finally:
+            pool.terminate()
+        if failures:
+            abort('\n'.join(failures))
+    try:
+        return [ minify_file(*job) for job in jobs ]
+    except MinifyError, e:
+        abort(str(e))
+
+def _minify_job(job):
+    # Runs in a pool process, where an exception (let alone Fabric's SystemExit) would be lost
+    try:
+        minify_file(*job)
+    except MinifyError, e:
+        return str(e)
+
+def minified_paths(src, cmd, cache_dir):
+    "Cached minified file and source map for `src` under `cache_dir`, keyed by the hash of the source and command."
+    key = hashlib.sha1(cmd + '\0' + file_digest(src)).hexdigest()
+    return cache_dir/key + '.js', cache_dir/key + '.js.map'
+
+def minify_file(src, cmd, cache_dir):
+    """ Minifies `src` using the command template `cmd` (with `{src}`, `{out}` and `{map}` fields),
+        unless already cached under `cache_dir`. Returns the minified file and its source map
+        (or None, if the command didn't write one).
+    """
+    out, map_file = minified_paths(src, cmd, cache_dir)
+    if not out.exists():
+        cache_dir.makedirs_p()
+        tmp_out, tmp_map = p(out + '.%s.tmp' % os.getpid()), p(map_file + '.%s.tmp' % os.getpid())
+        # Run the minify command, adding npm's bin directory
+        cmd_env = dict(os.environ, PATH=os.pathsep.join([ os.path.abspath('node_modules/.bin'), os.environ.get('PATH', '') ]))
+        proc = subprocess.Popen(cmd.format(src=src, out=tmp_out, map=tmp_map), shell=True, env=cmd_env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise MinifyError('Unable to minify %s:\n%s' % (src, output))
+        if tmp_map.exists():
+            os.rename(tmp_map, map_file)
+        os.rename(tmp_out, out)
+    return out, (map_file if map_file.exists() else None)
+
+def file_digest(f):
+    "SHA1 of the file `f`, read in chunks."
+    digest = hashlib.sha1()
+    with f.open('rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_manifest(manifest_file):
+    """ Loads a bundle manifest, returning a dict with the list of `inputs` plus each
+        input entry under its name, or an empty dict if there's no usable manifest.
+    """
+    try:
+        inputs = json.loads(manifest_file.text())
+    except (IOError, OSError, ValueError):
+        return {}
+    manifest = dict( (entry['name'], entry) for entry in inputs )
+    manifest['inputs'] = inputs
+    return manifest
 
+def write_manifest(manifest_file, inputs):
+    with atomic_write(manifest_file) as f:
+        json.dump(inputs, f, indent=1, sort_keys=True)
 
+@contextmanager
+def atomic_write(target):
+    "Yields a file to write in place of `target`, which is replaced only once the block completes."
+    target = p(target)
+    target.parent.makedirs_p()
+    tmp = p(target + '.tmp')
+    with tmp.open('wb') as f:
+        yield f
+    os.rename(tmp, target)
@@ -2,27 +2,56 @@
 # -*- coding: utf-8 -*-
 "Deploy Tasks"
 
+import hashlib, json, os, subprocess, sys, time
+from contextlib import contextmanager
 from fabric.api import *
 from fabric.colors import white, blue, cyan, green, yellow, red, magenta
 from fabric.contrib.files import exists
 from fabric.contrib.project import rsync_project
+from fabric.utils import _AttributeDict
 
-from stages import ensure_stage
+from path import path as p # renamed to avoid conflict w/ fabric.api.path
+
+from stages import ensure_stage, stage_env, STAGE_NAMES, STAGE_TABLE
 from util import *
 
 
 def add_coke_to_path():
-    return 'export PATH=$PATH:' + env.target_dir + '/node_modules/.bin/'
+    return add_coke_to_path_for(env)
+
+def add_coke_to_path_for(e):
+    return 'export PATH=$PATH:' + e.target_dir + '/node_modules/.bin/'
+
+
+@contextmanager
+def deferred_permissions():
+    """ Collects the permission fixes requested by tasks in the block and applies each
+        one once when it exits. Nested blocks defer to the outermost one.
+    """
+    if env.get('pending_permissions') is not None:
+        yield
+        return
+    env.pending_permissions = []
+    try:
+        yield
+    finally:
+        pending, env.pending_permissions = env.pending_permissions, None
+        for target, user, group in pending:
+            _fix_permissions(target, user, group)
 
 
 @task(default=True)
 @expand_env
 @ensure_stage
-def code_and_data():
-    """ Deploy the project.
+def code_and_data(dry_run=None):
+    """ Deploy the project, running only the steps the host actually needs (dry_run=yes just prints them).
     """
-    code_and_dependencies()
-    only_data()
+    if dry_run is None:
+        dry_run = env.dry_run
+    steps = plan_deploy()
+    print_plan(steps)
+    if not truthy(dry_run):
+        run_plan(steps)
 
 
 @task
@@ -31,10 +60,9 @@ def code_and_data():
 def only_code():
     """ Deploy only the code
     """
-    update_branch()
-    remove_derived()
-    build()
-    bundle()
+    with deferred_permissions():
+        update_branch()
+        build_if_changed()
 
 
 @task
@@ -43,14 +71,13 @@ def only_code():
 def code_and_dependencies():
     """ Deploy the code and re-install dependencies
     """
-    make_directories()
-    clone()
-    update_branch()
-    install_dependencies()
-    
-    remove_derived()
-    build()
-    bundle()
+    with deferred_permissions():
+        make_directories()
+        clone()
+        update_branch()
+        install_dependencies()
+        
+        build_if_changed()
     
     stop_server()
     start_server()
@@ -62,10 +89,16 @@ def code_and_dependencies():
 def only_data():
     """ Deploy only the data
     """
-    make_directories_data()
-    clone_data()
-    update_branch_data()
-    link_data()
+    with deferred_permissions():
+        make_directories_data()
+        changes = update_data(clone_data())
+    publish_data(changes)
+
+def update_data(cloned=False):
+    "Pulls the data repository and syncs its links (all of them if it was just `cloned`), returning its changes."
+    changes = pull_data()
+    sync_data_links(full=cloned)
+    return changes
 
 
 @task
@@ -73,8 +106,9 @@ def only_data():
 @ensure_stage
 @msg('Making Target Directories')
 def make_directories():
-    if not exists('%(target_dir)s' % env, use_sudo=True):
-        sudo('mkdir -p %(target_dir)s' % env)
+    with batch() as b:
+        b.sudo('mkdir -p %(target_dir)s' % env, unless='test -e %(target_dir)s' % env)
+    if not b[0].skipped:
         execute(fix_permissions)
 
 @task
@@ -82,33 +116,56 @@ def make_directories():
 @ensure_stage
 @msg('Making Target Directories for Data')
 def make_directories_data():
-    if not exists('%(target_data_dir)s' % env, use_sudo=True):
-        sudo('mkdir -p %(target_data_dir)s' % env)
+    with batch() as b:
+        b.sudo('mkdir -p %(target_data_dir)s' % env, unless='test -e %(target_data_dir)s' % env)
+    if not b[0].skipped:
         execute(fix_permissions_data)
 
 @task
 @expand_env
 @ensure_stage
-@msg('Fixing Permissions')
 def fix_permissions(user=None, group=None):
-    """ Recursively fixes permissions on the deployment host.
+    """ Fixes permissions on the deployment host.
     """
-    if user  is None: user  = env.owner
-    if group is None: group = env.group
-    sudo('chmod -R g+w %(target_dir)s' % env)
-    sudo('chown -R %s:%s %s' % (user, group, env.target_dir))
+    _fix_permissions(env.target_dir, user, group)
 
 @task
 @expand_env
 @ensure_stage
-@msg('Fixing Permissions in Data directory')
 def fix_permissions_data(user=None, group=None):
-    """ Recursively fixes permissions on the deployment host.
+    """ Fixes permissions in the data directory on the deployment host.
     """
+    _fix_permissions(env.target_data_dir, user, group)
+
+def _fix_permissions(target, user=None, group=None):
     if user  is None: user  = env.owner
     if group is None: group = env.group
-    sudo('chmod -R g+w %(target_data_dir)s' % env)
-    sudo('chown -R %s:%s %s' % (user, group, env.target_data_dir))
+    
+    pending = env.get('pending_permissions')
+    if pending is not None:
+        if (target, user, group) not in pending:
+            pending.append( (target, user, group) )
+        return
+    
+    puts(green('Fixing Permissions in %s...' % target, bold=True))
+    for cmd in permission_commands(target, user, group):
+        sudo(cmd)
+    puts(white('Woo.\n'))
+
+def permission_commands(target, user, group, mode=None):
+    """ Commands making `target` group-writable and owned by `user:group`.
+        
+        The default 'incremental' mode (see `env.permissions_mode`) only touches paths that
+        are actually wrong, rather than rewriting every inode under the tree.
+    """
+    opts = dict(target=target, user=user, group=group)
+    if (mode or env.permissions_mode) == 'recursive':
+        return [ 'chmod -R g+w %(target)s' % opts,
+                 'chown -R %(user)s:%(group)s %(target)s' % opts ]
+    return [
+        'find %(target)s -not -type l -not -perm -g+w -exec chmod g+w {} +' % opts,
+        'find %(target)s \\( -not -user %(user)s -o -not -group %(group)s \\) -exec chown -h %(user)s:%(group)s {} +' % opts,
+    ]
 
 @task
 @expand_env
@@ -117,9 +174,10 @@ def fix_permissions_data(user=None, group=None):
 def clone():
     """ Clones source on deployment host if not present.
     """
-    if exists('%(target_dir)s/.git' % env, use_sudo=True): return
-    sudo('git clone %(git_origin)s %(target_dir)s' % env)
-    execute(fix_permissions)
+    with batch() as b:
+        b.sudo('git clone %(git_origin)s %(target_dir)s' % env, unless='test -e %(target_dir)s/.git' % env)
+    if not b[0].skipped:
+        execute(fix_permissions)
 
 @task
 @expand_env
@@ -128,9 +186,11 @@ def clone():
 def clone_data():
     """ Clones data repository on deployment host if not present.
     """
-    if exists('%(target_data_dir)s/.git' % env, use_sudo=True): return
-    sudo('git clone %(git_data_origin)s %(target_data_dir)s' % env)
-    execute(fix_permissions_data)
+    with batch() as b:
+        b.sudo(data_clone_command(env), unless='test -e %(target_data_dir)s/.git' % env)
+    if not b[0].skipped:
+        execute(fix_permissions_data)
+    return not b[0].skipped
 
 @task
 @expand_env
@@ -140,10 +200,8 @@ def checkout():
     """
     # TODO: Locally saved data files will cause yelling?
     with cd(env.target_dir):
-        sudo('git fetch --all')
-        opts = {'track' : '--track origin/' if env.git_branch not in branches() else ''}
-        opts.update(env)
-        sudo('git checkout %(track)s%(git_branch)s' % opts)
+        with batch() as b:
+            queue_checkout(b, env.git_branch)
 
 @task
 @expand_env
@@ -152,10 +210,16 @@ def checkout_data():
     """ Checks out proper data branch on deployment host.
     """
     with cd(env.target_data_dir):
-        sudo('git fetch --all')
-        opts = {'track' : '--track origin/' if env.git_data_branch not in branches() else ''}
-        opts.update(env)
-        sudo('git checkout %(track)s%(git_data_branch)s' % opts)
+        with batch() as b:
+            for cmd in data_update_commands(env):
+                b.sudo(cmd)
+
+def queue_checkout(b, branch):
+    "Queues commands on the batch `b` checking out `branch`, tracking origin's if there's no local one."
+    has_branch = 'git rev-parse --verify --quiet refs/heads/%s >/dev/null' % branch
+    b.sudo('git fetch --all')
+    b.sudo('git checkout %s' % branch, only_if=has_branch)
+    b.sudo('git checkout --track origin/%s' % branch, unless=has_branch)
 
 @task
 @expand_env
@@ -165,55 +229,353 @@ def update_branch():
     """ Runs git pull on the deployment host.
     """
     with cd(env.target_dir):
-        execute(checkout)
-        sudo('git pull origin %(git_branch)s' % env)
-        execute(fix_permissions)
+        with batch() as b:
+            queue_checkout(b, env.git_branch)
+            b.sudo('git pull origin %(git_branch)s' % env)
+    execute(fix_permissions)
 
 @task
 @expand_env
 @ensure_stage
-@msg('Updating Branch for Data repository')
 def update_branch_data():
-    """ Runs git pull on the deployment host.
+    """ Runs git pull on the deployment host, returning the (status, path) of each file it changed.
     """
+    changes = pull_data()
+    execute(fix_permissions_data)
+    return changes
+
+@msg('Updating Branch for Data repository')
+def pull_data():
+    "Pulls the data repository, returning the (status, path) of each file that changed; leaves permissions alone."
     with cd(env.target_data_dir):
-        execute(checkout_data)
-        sudo('git pull origin %(git_data_branch)s' % env)
+        with batch() as b:
+            b.sudo('git update-ref %s HEAD' % PREVIOUS_DATA_REF)
+            for cmd in data_update_commands(env):
+                b.sudo(cmd)
+            diff = b.sudo('git diff --no-renames --name-status %s HEAD' % PREVIOUS_DATA_REF)
+            gc = data_gc_command(env)
+            if gc:
+                b.sudo(gc)
+    
+    changes = []
+    for line in b[diff].splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) == 2:
+            changes.append(tuple(fields))
+    return changes
+
+# Where `update_branch_data` records the data repository's HEAD before pulling
+PREVIOUS_DATA_REF = 'refs/limn-deploy/previous'
+
+def data_clone_command(e):
+    """ Clones just `git_data_branch` of the data repository, shallow (`git_data_depth`)
+        and partial (`git_data_filter`) if configured.
+    """
+    opts = ['--single-branch', '--branch', e.git_data_branch]
+    if e.git_data_depth:
+        opts += ['--depth', str(e.git_data_depth)]
+    if e.git_data_filter:
+        opts.append('--filter=%s' % e.git_data_filter)
+    return 'git clone %s %s %s' % (' '.join(opts), e.git_data_origin, e.target_data_dir)
+
+def data_update_commands(e):
+    """ Commands bringing the data checkout up to origin's `git_data_branch`, fetching only that branch.
+        
+        The branch is reset onto origin's rather than merged, as a shallow fetch doesn't carry
+        the history a merge needs; uncommitted local changes still stop the checkout. The commit
+        `PREVIOUS_DATA_REF` points at is already local, so diffing against it fetches nothing.
+    """
+    branch = e.git_data_branch
+    depth = ' --depth %s' % e.git_data_depth if e.git_data_depth else ''
+    return [
+        'git fetch%s origin +refs/heads/%s:refs/remotes/origin/%s' % (depth, branch, branch),
+        'git checkout -B %s origin/%s' % (branch, branch),
+    ]
+
+def data_gc_command(e, policy=None):
+    """ Housekeeping run after each data update, per `git_data_gc` (or `policy`):
+        'auto' lets git decide when to repack, 'prune' drops everything no longer reachable
+        (ie, history beyond a shallow clone's depth) every time, and 'never' does nothing.
+    """
+    policy = policy or e.git_data_gc
+    if policy == 'auto':
+        return 'git gc --auto --quiet'
+    if policy == 'prune':
+        return 'git reflog expire --expire=now --all && git gc --prune=now --quiet'
+    if policy == 'never':
+        return None
+    abort(red('Unknown git_data_gc policy %r!' % policy, bold=True))
+
+@task
+@expand_env
+@ensure_stage
+@msg('Collecting Garbage in Data repository')
+def gc_data(policy='prune'):
+    """ Repacks the data repository, by default dropping history no longer reachable.
+    """
+    cmd = data_gc_command(env, policy)
+    if cmd:
+        with cd(env.target_data_dir):
+            sudo(cmd)
         execute(fix_permissions_data)
 
+@msg('Publishing Data Changes')
+def publish_data(changes):
+    """ Tells the running server which data files changed (POSTing their paths, one per line,
+        to `env.data_reload_url`) so it can drop just those from its caches without a restart.
+    """
+    if not changes:
+        puts(cyan('No data files changed.'))
+        return
+    puts('%d data files changed.' % len(changes))
+    if not env.data_reload_url:
+        puts(yellow('No data_reload_url set; the server will see the changes when its caches expire or it restarts.'))
+        return
+    paths = '\n'.join( path for _, path in changes )
+    sudo('printf %%s %s | curl -sf -X POST --data-binary @- %s' % (shell_quote(paths), shell_quote(data_reload_url(env))))
+
+def data_reload_url(e):
+    return '%s?to=%s' % (e.data_reload_url, e.target_data_to)
+
 @task
 @expand_env
 @ensure_stage
 @msg('Installing Dependencies Locally and Synchronizing')
 def install_dependencies():
-    """ Runs npm install on a fresh checkout, then rsyncs the node_modules
+    """ Points node_modules at the cached install for the branch's package.json, installing and
+        rsyncing it only if neither the deployment host nor the local cache already has it.
     """
-    env.staging_dir = '/tmp/limn-deployer-staging'
+    target_deps = ensure_dependencies(env.git_branch)
+    link_dependencies(env.target_dir, target_deps)
+    prune_dependencies()
+    execute(fix_permissions)
+
+def ensure_dependencies(rev):
+    """ Ensures the host's dependency cache holds node_modules for the package.json at `rev`,
+        returning the cache directory.
+        
+        On a miss, the host prepares to receive the install while npm runs here: it snapshots the
+        install to base the transfer on into staging, and lists it if the local cache can't.
+    """
+    staging = stage_manifests(rev)
+    target_deps = '%(target_deps_dir)s/%(deps_key)s' % env
+    
+    with batch() as b:
+        ready = b.sudo('[ -e %s/.complete ] && echo yes; true' % target_deps)
+        seed  = b.sudo(dependencies_seed_command())
+    if b[ready] == 'yes':
+        puts(cyan('Dependencies %(deps_key)s are already on the host.' % env))
+    else:
+        seed = b[seed].strip() or None
+        jobs = { 'host'  : lambda: prepare_dependencies_staging(seed),
+                 'local' : lambda: install_dependencies_locally(staging) }
+        seed_manifest, local_deps = pmap(lambda name: jobs[name](), ['host', 'local'], workers=2)
+        transfer_dependencies(local_deps, target_deps, seed, seed_manifest)
+        sudo('touch %s/.complete' % target_deps)
+        _fix_permissions(target_deps)
     
-    # get a clean clone and checkout the desired branch
     local('rm -rf %(staging_dir)s' % env)
-    local('git clone %(git_origin)s %(staging_dir)s' % env)
-    local('cd %(staging_dir)s && git checkout %(git_branch)s' % env)
+    return target_deps
+
+def dependencies_staging():
+    "Where new dependency installs are assembled on the host, beside the cache so the final move is a rename."
+    return '%(target_deps_dir)s/.staging' % env
+
+def prepare_dependencies_staging(seed):
+    """ Empties the host's staging directory, owned by the connecting user (who sends into it),
+        copying `seed`'s node_modules there as `seed` (copy-on-write where the filesystem supports it).
+        Returns `seed`'s manifest if the local cache doesn't have it, else None.
+        
+        Runs in a `pmap()` worker alongside the local npm install, so touches no global state (see there).
+    """
+    opts = dict(env, staging=dependencies_staging(), seed=seed)
+    listed = seed and not (env.deps_cache_dir/p(seed).basename()/'.complete').exists()
+    copy = ' && cp -a --reflink=auto %(seed)s/node_modules %(staging)s/seed' % opts if seed else ''
+    # The listing goes to a file rather than the terminal, as it runs to thousands of lines
+    listing = " && (cd %(seed)s/node_modules && find . -type f -printf '%%P\\t%%s\\n') > %(staging)s/seed.manifest" % opts if listed else ''
+    sudo(('rm -rf %(staging)s && mkdir -p %(staging)s' + copy + listing + ' && chown -R %(user)s %(staging)s') % opts)
+    if not listed:
+        return None
+    
+    manifest = p(env.staging_dir)/'seed.manifest'
+    get('%(staging)s/seed.manifest' % opts, manifest)
+    return dict( (path, int(size)) for path, size in
+                 (line.rsplit('\t', 1) for line in manifest.lines(retain=False) if '\t' in line) )
+
+def transfer_dependencies(local_deps, target_deps, seed, seed_manifest=None):
+    """ Moves `local_deps`/node_modules into `target_deps` on the host, via the staging directory
+        `prepare_dependencies_staging` made.
+        
+        If most files are unchanged from `seed`, rsync sends only the differences against its
+        snapshot; otherwise the tree goes as one compressed tar stream, unpacked as it arrives,
+        as per-file rsync round-trips through the gateway cost far more than the bytes do.
+    """
+    mode = choose_dependencies_transfer(local_deps, seed, seed_manifest)
+    opts = dict(env, staging=dependencies_staging(), local_deps=local_deps, target_deps=target_deps,
+                ssh=ssh_command(), target=ssh_target(), exclude=' '.join( '--exclude=%s' % d for d in VCS_DIRS ))
+    
+    if mode == 'rsync':
+        puts(cyan('Sending the changes from %s.' % p(seed).basename()))
+        sudo('mv %(staging)s/seed %(staging)s/node_modules' % opts)
+        local("rsync -az --checksum --delete %(exclude)s -e '%(ssh)s' %(local_deps)s/node_modules %(target)s:%(staging)s/" % opts)
+    else:
+        puts(cyan('Sending the whole tree.'))
+        local("tar -C %(local_deps)s --exclude-vcs -czf - node_modules | %(ssh)s %(target)s 'tar -C %(staging)s -xzf -'" % opts)
+    sudo('rm -rf %(target_deps)s && mkdir -p %(target_deps)s && mv %(staging)s/node_modules %(target_deps)s/ && rm -rf %(staging)s' % opts)
+
+# Version control metadata isn't shipped with node_modules
+VCS_DIRS = ('.git', '.svn', '.hg', '.bzr', 'CVS')
+
+def dependencies_seed_command():
+    "Prints the complete dependency install on the host to base a transfer on: the checkout's, else the newest."
+    return ('for d in $(dirname "$(readlink %(target_dir)s/node_modules)") $(ls -1td %(target_deps_dir)s/*/ 2>/dev/null); '
+            'do [ -e $d/.complete ] && echo ${d%%/} && break; done; true' % env)
+
+def choose_dependencies_transfer(local_deps, seed, seed_manifest=None):
+    """ 'rsync' if `env.deps_transfer` says so, or (when 'auto') at least `env.deps_delta_threshold`
+        of the files in `local_deps` are the same size at the same path in `seed` (per `seed_manifest`,
+        or the local cache's copy of it); otherwise 'tar'.
+    """
+    if not seed or env.deps_transfer == 'tar':
+        return 'tar'
+    if env.deps_transfer == 'rsync':
+        return 'rsync'
+    
+    new = dependencies_manifest(local_deps/'node_modules')
+    seed_key = p(seed).basename()
+    old = seed_manifest
+    if old is None:
+        old = dependencies_manifest(env.deps_cache_dir/seed_key/'node_modules')
+    
+    unchanged = sum( 1 for path, size in new.iteritems() if old.get(path) == size )
+    puts('%d of %d dependency files unchanged from %s.' % (unchanged, len(new), seed_key))
+    if new and unchanged >= float(env.deps_delta_threshold) * len(new):
+        return 'rsync'
+    return 'tar'
+
+def dependencies_manifest(node_modules):
+    "Maps the path (relative to `node_modules`) of each file in it to its size."
+    manifest = {}
+    for root, dirs, files in os.walk(node_modules):
+        dirs[:] = [ d for d in dirs if d not in VCS_DIRS ]
+        rel = os.path.relpath(root, node_modules)
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                manifest[os.path.normpath(os.path.join(rel, name))] = os.path.getsize(path)
+    return manifest
+
+def ssh_target():
+    "The current host, as ssh and rsync name it."
+    return '%(user)s@%(host)s' % env
+
+def ssh_command():
+    "ssh as run by `local()` transfers to the current host (relying on ~/.ssh/config for any gateway, as rsync always has)."
+    return 'ssh -p %(port)s' % env
+
+def stage_manifests(rev):
+    """ Writes the dependency manifests at `rev` into a local staging directory, returning
+        it and setting `env.deps_key`.
+    """
+    env.staging_dir = '/tmp/limn-deployer-staging'
+    
+    # pull just the dependency manifests for the desired revision out of the local mirror
+    staging = p(env.staging_dir)
+    staging.rmtree(ignore_errors=True)
+    staging.makedirs()
+    for name in DEPENDENCY_MANIFESTS:
+        contents = mirror_show(rev, name)
+        if contents is not None:
+            (staging/name).write_bytes(contents)
+    if not (staging/'package.json').exists():
+        abort(red('No package.json found at %r in %s!' % (rev, env.git_origin), bold=True))
+    
+    env.deps_key = dependencies_key(staging)
+    return staging
+
+def link_dependencies(checkout, target_deps):
+    "Atomically repoints `checkout`/node_modules (replacing the directory left by older deploys)."
+    with cd(checkout):
+        sudo('[ ! -d node_modules -o -L node_modules ] || rm -rf node_modules')
+        sudo('ln -sfn %s/node_modules node_modules.tmp && mv -Tf node_modules.tmp node_modules' % target_deps)
+
+def dependencies_key(checkout):
+    "Content hash of the dependency manifests in `checkout`, identifying an install of node_modules."
+    digest = hashlib.sha1()
+    for name in DEPENDENCY_MANIFESTS:
+        f = checkout/name
+        if f.exists():
+            digest.update('%s\0%s\0' % (name, f.bytes()))
+    return digest.hexdigest()[:16]
+
+DEPENDENCY_MANIFESTS = ('package.json', 'npm-shrinkwrap.json', 'package-lock.json')
+
+def install_dependencies_locally(checkout):
+    """ Returns the local cache directory holding node_modules for `env.deps_key`,
+        running npm install there if it is not already cached.
+    """
+    local_deps = env.deps_cache_dir/env.deps_key
+    if (local_deps/'.complete').exists():
+        puts(cyan('Using locally cached dependencies %(deps_key)s.' % env))
+        (local_deps/'.complete').touch() # marks it recently used, for `prune_local_dependencies()`
+        return local_deps
     
-    ## copy the package.json file to the current directory and run npm install
-    local('cp %(staging_dir)s/package.json .' % env)
+    local_deps.rmtree(ignore_errors=True)
+    local_deps.makedirs()
+    for name in DEPENDENCY_MANIFESTS:
+        if (checkout/name).exists():
+            (checkout/name).copy(local_deps/name)
     ## TODO: npm install from a blessed mirror so we can deploy to production
-    local('npm install' % env)
-    
-    ## delete the staging directory on the remote host
-    ## copy the node_modules to staging on the remote
-    ## delete the node_modules on the remote target
-    ## move the staging node_modules to the remote target
-    ## clean up locally
-    sudo('rm -rf %(staging_dir)s' % env)
-    local('rsync -Cavz node_modules {0}:{1}/'.format(env.hosts[0], env.staging_dir))
-    sudo('rm -rf %(target_dir)s/node_modules' % env)
-    sudo('chmod -R 777 %(staging_dir)s' % env)
-    sudo('mv %(staging_dir)s/node_modules %(target_dir)s/' % env)
-    execute(fix_permissions)
-    local('rm -rf node_modules')
-    local('rm package.json')
-    local('rm -rf %(staging_dir)s' % env)
+    # Not `local()`, whose failures only warn while `env.warn_only` is set (which may be by another
+    # thread: this runs in a worker alongside the host's preparations). A broken install must never
+    # be marked complete, or it would be reused from the cache on every later deploy.
+    puts('[localhost] npm install (in %s)' % local_deps)
+    try:
+        subprocess.check_call(['npm', 'install'], cwd=local_deps)
+    except (OSError, subprocess.CalledProcessError), e:
+        abort(red('npm install failed in %s: %s' % (local_deps, e), bold=True))
+    (local_deps/'.complete').touch()
+    prune_local_dependencies()
+    return local_deps
+
+def prune_local_dependencies():
+    """ Removes all but the `env.deps_cache_keep` most recently used installs (besides `env.deps_key`'s)
+        from the local cache, along with any left incomplete by a failed install.
+    """
+    installs = [ d for d in env.deps_cache_dir.dirs() if d.basename() != env.deps_key ]
+    complete = sorted(( d for d in installs if (d/'.complete').exists() ),
+                      key=lambda d: (d/'.complete').mtime, reverse=True)
+    for d in installs:
+        if d not in complete[:int(env.deps_cache_keep)]:
+            d.rmtree(ignore_errors=True)
+
+def prune_dependencies():
+    """ Removes all but the newest `env.deps_cache_keep` dependency installs on the host,
+        always keeping those linked from the checkout or a retained release.
+    """
+    in_use = sudo('for link in %(target_dir)s/node_modules %(releases_dir)s/*/node_modules; do '
+                  '[ -L $link ] && basename $(dirname $(readlink $link)); done; true' % env).split()
+    keep = ' '.join( '-e %s' % key for key in set(in_use + [env.deps_key]) )
+    sudo('cd %s && ls -1t | grep -vx %s | tail -n +$((%s+1)) | xargs -r rm -rf' % (env.target_deps_dir, keep, int(env.deps_cache_keep)))
+
+@task
+@expand_env
+@ensure_stage
+def build_if_changed(force=False):
+    """ Removes derived files, then builds and bundles, unless the sources and node_modules are unchanged since the last build.
+    """
+    lines = sudo('cd %(target_dir)s && echo $(git rev-parse HEAD^{tree}) $(readlink node_modules) '
+                 '&& (cat %(build_fingerprint)s 2>/dev/null || true)' % env).splitlines()
+    fingerprint = lines[0].strip()
+    built = lines[1].strip() if len(lines) > 1 else None
+    if not truthy(force) and fingerprint == built:
+        puts(cyan('Sources and dependencies are unchanged since the last build; skipping it.'))
+        return
+    remove_derived()
+    build()
+    bundle()
+    # Written last so an interrupted build is never mistaken for a complete one
+    sudo('echo %s > %s' % (fingerprint, env.build_fingerprint))
 
 @task
 @expand_env
@@ -224,7 +586,7 @@ def remove_derived():
     """
     
     # Remove derived files to ensure they get regenerated
-    sudo('rm -rf %(target_dir)s/var/js %(target_dir)s/var/vendor %(target_dir)s/var/css %(target_dir)s/var/.cache' % env)
+    sudo('rm -rf %(build_fingerprint)s %(target_dir)s/var/js %(target_dir)s/var/vendor %(target_dir)s/var/css %(target_dir)s/var/.cache' % env)
 
 @task
 @expand_env
@@ -233,12 +595,103 @@ def remove_derived():
 def link_data():
     """ adds Sym-Links to the specified data directory
     """
-    if not exists('%(target_var_dir)s' % env, use_sudo=True):
-        sudo('mkdir -p %(target_var_dir)s' % env)
-    with cd(env.target_dir):
-        with prefix(add_coke_to_path()):
-            sudo('coke -v %(target_var_dir)s -d %(target_data_dir)s -t %(target_data_to)s link_data' % env)
-            execute(fix_permissions_data)
+    sync_data_links(full=True)
+
+@msg('Syncing Data Links')
+def sync_data_links(full=False):
+    "Brings the data links up to date with the data checkout, relinking everything if `full`."
+    sudo('set -e\nfull=%s\n%s' % ('1' if full else '', data_links_script(env)))
+
+def data_links_script(e):
+    """ Shell script syncing the links to the stage's data files in `target_var_dir` with the data
+        checkout, by comparing it to the index (`data_index`) of each file's blob hash and link
+        written last time.
+        
+        Only added files are linked, only deleted files' links removed, and permissions fixed
+        only on those, on modified files and in .git. When there's no index, `$full` is set, or
+        a file turns up in a directory with nothing indexed to go by, `coke link_data` relinks
+        everything and the index is rebuilt from the links it made.
+    """
+    opts = dict(e, coke_path=add_coke_to_path_for(e), plan=DATA_INDEX_PLAN, rebuild=DATA_INDEX_REBUILD,
+        permissions='\n    '.join(permission_commands(e.target_data_dir, e.owner, e.group, e.permissions_mode)),
+        git_permissions='\n    '.join(permission_commands(e.target_data_dir + '/.git', e.owner, e.group, e.permissions_mode)))
+    return '''index=%(data_index)s
+mkdir -p %(target_var_dir)s
+cd %(target_data_dir)s
+git ls-files -s | awk -F'\\t' '{ split($1, f, " "); print $2 "\\t" f[2] }' > $index.files
+: > $index.actions
+[ -s $index ] || full=1
+if [ -z "$full" ]
+then
+    awk -v out=$index.new -v data=%(target_data_dir)s '%(plan)s' $index $index.files > $index.actions
+    if grep -q '^relink' $index.actions; then full=1; fi
+fi
+if [ -n "$full" ]
+then
+    (cd %(target_dir)s && %(coke_path)s && coke -v %(target_var_dir)s -d %(target_data_dir)s -t %(target_data_to)s link_data)
+    find %(target_var_dir)s -path %(target_data_dir)s -prune -o -type l -printf '%%l\\t%%p\\n' > $index.links
+    awk -v data=%(target_data_dir)s '%(rebuild)s' $index.links $index.files > $index.new
+    %(permissions)s
+else
+    while IFS=$'\\t' read -r action a b
+    do
+        case $action in
+            rm) rm -f "$a" ;;
+            ln) ln -sfn "$a" "$b" ;;
+        esac
+    done < $index.actions
+    awk -F'\\t' '$1 == "fix" { print $2 }' $index.actions | tr '\\n' '\\0' | xargs -0 -r chown -h %(owner)s:%(group)s
+    awk -F'\\t' '$1 == "fix" { print $2 }' $index.actions | tr '\\n' '\\0' | xargs -0 -r chmod g+w
+    %(git_permissions)s
+fi
+mv $index.new $index
+rm -f $index.files $index.actions $index.links''' % opts
+
+# awk comparing the data index (path, blob, link) with the checkout's files (path, blob). It writes the
+# new index to `out` and prints the actions needed: 'rm <link>' for deleted files' links, 'ln <file> <link>'
+# for added files (linked beside their neighbours' links), 'fix <path>' for whatever needs its permissions
+# fixed, and 'relink' if an added file has no indexed neighbours to go by.
+DATA_INDEX_PLAN = r'''
+function dirname(s)  { return sub(/\/[^\/]*$/, "", s) ? s : "." }
+function basename(s) { sub(/.*\//, "", s); return s }
+BEGIN { FS = OFS = "\t" }
+FILENAME == ARGV[1] {
+    blob[$1] = $2; link[$1] = $3; d = dirname($1); known[d] = 1
+    if ($3 != "-") linkdir[d] = dirname($3)
+    next
+}
+{
+    path = $1; seen[path] = 1; l = "-"
+    if (path in blob) {
+        l = link[path]
+        if (blob[path] != $2) print "fix", data "/" path
+    } else {
+        d = dirname(path)
+        if (d in linkdir) {
+            l = linkdir[d] "/" basename(path)
+            print "ln", data "/" path, l
+            print "fix", l
+            print "fix", data "/" path
+        } else if (d in known) {
+            print "fix", data "/" path
+        } else {
+            print "relink"
+        }
+    }
+    print path, $2, l > out
+}
+END { for (path in blob) if (!(path in seen) && link[path] != "-") print "rm", link[path] }
+'''
+
+# awk building the data index from the links `coke link_data` made (target, link) and the checkout's files (path, blob)
+DATA_INDEX_REBUILD = r'''
+BEGIN { FS = OFS = "\t" }
+FILENAME == ARGV[1] {
+    if (index($1, data "/") == 1) linkof[substr($1, length(data) + 2)] = $2
+    next
+}
+{ print $1, $2, (($1 in linkof) ? linkof[$1] : "-") }
+'''
 
 @task
 @expand_env
@@ -268,25 +721,647 @@ def bundle():
 @task
 @expand_env
 @ensure_stage
-@msg('Stop Node.js')
 def stop_server():
     """ Stop server on the deployment host.
     """
-    if env.provider == 'supervisor':
-        sudo("supervisorctl stop %(provider_job)s" % env)
-    elif env.provider == 'upstart':
-        sudo("stop %(provider_job)s" % env)
+    request_server('stop')
 
 @task
 @expand_env
 @ensure_stage
-@msg('Start Node.js')
 def start_server():
     """ Start/restart server on the deployment host.
     """
-    if env.provider == 'supervisor':
-        sudo("supervisorctl restart %(provider_job)s" % env)
-    elif env.provider == 'upstart':
-        sudo("start %(provider_job)s" % env)
+    request_server('start')
+
+PROVIDER_COMMANDS = {
+    'supervisor' : { 'stop':'supervisorctl stop %s', 'start':'supervisorctl restart %s',
+                     'running':'supervisorctl status %s | grep -q RUNNING',
+                     'failed':'supervisorctl status %s | grep -qE "FATAL|EXITED|BACKOFF|STOPPED"',
+                     'job_file':'/etc/supervisor/conf.d/%s.conf', 'reload':'supervisorctl reread && supervisorctl update' },
+    'upstart'    : { 'stop':'stop %s', 'start':'start %s',
+                     'running':'status %s | grep -q running',
+                     'failed':'status %s | grep -q stop/',
+                     'job_file':'/etc/init/%s.conf', 'reload':'initctl reload-configuration' },
+}
+
+def request_server(action):
+    """ Runs `action` ('stop' or 'start') on the stage's server now or, inside a `restart_wave()`,
+        queues it to be run once per (host, provider, provider_job) when the wave ends.
+    """
+    job = server_job()
+    pending = env.get('pending_restarts')
+    if pending is None:
+        return control_server(action, env.provider, job)
+    key = (env.host_string, env.provider, job)
+    for entry in pending:
+        if entry[0] == key:
+            entry[1].append(action)
+            return
+    pending.append( (key, [action]) )
+
+def server_job():
+    "The job serving the stage: its live release's once it has had a release deploy, else `provider_job`."
+    if env.provider not in PROVIDER_COMMANDS:
+        return env.provider_job
+    port = sudo('cat %(releases_dir)s/.state/%(provider_job)s.port 2>/dev/null; true' % env).strip()
+    return release_job(port) if port else env.provider_job
+
+def control_server(action, provider, job):
+    if provider not in PROVIDER_COMMANDS: return
+    puts(green('%s Node.js (%s)...' % (action.capitalize(), job), bold=True))
+    sudo(PROVIDER_COMMANDS[provider][action] % job)
+    puts(white('Woo.\n'))
+
+@contextmanager
+def restart_wave(rolling=None):
+    """ Collects the server stops/starts requested in the block and, when it exits, runs
+        them once per (host, provider, provider_job), however many stages share the job.
+        
+        With `rolling` (default: `env.rolling_restarts`), each restarted job must be running
+        again before the next is touched.
+        
+        The restarts are run even if the block fails, as they are only requested once a job's
+        code is deployed, and its server would otherwise keep running the old code against it.
+    """
+    if env.get('pending_restarts') is not None:
+        yield
+        return
+    env.pending_restarts = []
+    try:
+        yield
+    except (Exception, SystemExit):
+        failure = sys.exc_info()
+        pending, env.pending_restarts = env.pending_restarts, None
+        if pending:
+            puts(yellow('Deploy failed; restarting the servers whose code was already deployed.', bold=True))
+            try:
+                run_restarts(pending, rolling)
+            except (Exception, SystemExit), e:
+                puts(red('Restarting after the failure failed too: %s' % e, bold=True))
+        raise failure[0], failure[1], failure[2]
+    pending, env.pending_restarts = env.pending_restarts, None
+    run_restarts(pending, rolling)
+
+def run_restarts(pending, rolling=None):
+    "Runs the stops/starts collected by `restart_wave()`."
+    if rolling is None:
+        rolling = env.rolling_restarts
+    for i, ((host, provider, job), actions) in enumerate(pending):
+        # A stop followed by a start is a restart; otherwise only the last request counts
+        steps = ['stop', 'start'] if actions[-1] == 'start' and 'stop' in actions else actions[-1:]
+        with settings(host_string=host):
+            for action in steps:
+                control_server(action, provider, job)
+            if truthy(rolling) and steps[-1] == 'start' and i < len(pending) - 1:
+                if not wait_until_running(provider, job):
+                    abort(red('%s did not come back up; not restarting the remaining jobs!' % job, bold=True))
+
+def wait_until_running(provider, job, timeout=None):
+    "Polls the provider until `job` is running, returning whether it was in time."
+    opts = dict(timeout=int(timeout or env.release_ready_timeout), check=PROVIDER_COMMANDS[provider]['running'] % job)
+    with settings(warn_only=True):
+        return sudo('for i in $(seq %(timeout)s); do %(check)s && exit 0; sleep 1; done; exit 1' % opts).succeeded
+
+
+
+
+
+### Planned Deploys
+
+@task
+@expand_env
+@ensure_stage
+def plan():
+    """ Prints the steps `deploy` would run, and why, without changing anything.
+    """
+    print_plan(plan_deploy())
+
+@msg('Probing Deployment Host')
+def probe():
+    """ Collects, in one round-trip, everything `plan_deploy` needs to know about the host:
+        which directories exist, the code and data checkouts' HEADs, origin's data branch,
+        where node_modules points, the last build's fingerprint, whether permissions need
+        fixing, and whether the server (the live release's, after a release deploy) is running.
+        
+        Also resolves the code branch and its dependency install (`env.deps_key`) locally.
+    """
+    state = _AttributeDict()
+    state.sha  = mirror_rev(env.git_branch)
+    if state.sha is None:
+        abort(red('Branch %r not found in %s!' % (env.git_branch, env.git_origin), bold=True))
+    state.tree = mirror_rev(state.sha + '^{tree}')
+    p(stage_manifests(state.sha)).rmtree(ignore_errors=True)
+    state.deps = '%(target_deps_dir)s/%(deps_key)s' % env
+    
+    opts = dict(env, deps=state.deps,
+        head='git rev-parse -q --verify HEAD && git symbolic-ref -q HEAD',
+        perms='\\( \\( -not -type l -not -perm -g+w \\) -o -not -user %(owner)s -o -not -group %(group)s \\) -print -quit' % env)
+    with batch() as b:
+        dirs     = b.sudo('for d in %(target_dir)s %(target_data_dir)s; do [ -e $d ] && echo $d; done; true' % opts)
+        code     = b.sudo('[ -d %(target_dir)s/.git ] && cd %(target_dir)s && %(head)s; true' % opts)
+        data     = b.sudo('[ -d %(target_data_dir)s/.git ] && cd %(target_data_dir)s && %(head)s; true' % opts)
+        data_tip = b.sudo('git ls-remote %(git_data_origin)s refs/heads/%(git_data_branch)s | cut -f1; true' % opts)
+        linked   = b.sudo('readlink %(target_dir)s/node_modules; true' % opts)
+        ready    = b.sudo('[ -e %(deps)s/.complete ] && echo yes; true' % opts)
+        built    = b.sudo('cat %(build_fingerprint)s 2>/dev/null; true' % opts)
+        perms    = b.sudo('[ -e %(target_dir)s ] && find %(target_dir)s %(perms)s; true' % opts)
+        perms_data = b.sudo('[ -e %(target_data_dir)s ] && find %(target_data_dir)s %(perms)s; true' % opts)
+        if env.provider in PROVIDER_COMMANDS:
+            check = PROVIDER_COMMANDS[env.provider]['running']
+            running = b.sudo('port=$(cat %(releases_dir)s/.state/%(provider_job)s.port 2>/dev/null); '
+                             'if [ -n "$port" ]; then echo release; %(release)s; else %(job)s; fi && echo yes; true'
+                             % dict(opts, release=check % release_job('$port'), job=check % env.provider_job))
+    
+    state.dirs       = b[dirs].split()
+    state.code       = (b[code].split() + [None, None])[:2]
+    state.data       = (b[data].split() + [None, None])[:2]
+    state.data_tip   = b[data_tip].strip() or None
+    state.linked     = b[linked].strip()
+    state.ready      = b[ready].strip() == 'yes'
+    state.built      = b[built].strip()
+    state.perms      = bool(b[perms].strip())
+    state.perms_data = bool(b[perms_data].strip())
+    served = b[running].split() if env.provider in PROVIDER_COMMANDS else ['yes']
+    state.release    = 'release' in served
+    state.running    = 'yes' in served
+    return state
+
+def plan_deploy():
+    """ The steps (name, reason) needed to bring the host up to date, judged from one `probe()`.
+        Names are keys of `PLAN_STEPS`.
+    """
+    state = probe()
+    steps = []
+    short = lambda sha: sha[:7] if sha else 'nothing'
+    
+    if env.target_dir not in state.dirs:
+        steps.append( ('make_directories', '%(target_dir)s is missing' % env) )
+    if not state.code[0]:
+        steps.append( ('clone', 'there is no code checkout') )
+    if state.code != [state.sha, 'refs/heads/' + env.git_branch]:
+        steps.append( ('update_branch', 'code is at %s; %s is at %s' % (short(state.code[0]), env.git_branch, short(state.sha))) )
+    
+    node_modules = state.deps + '/node_modules'
+    if not state.ready or state.linked != node_modules:
+        steps.append( ('install_dependencies', 'node_modules should be %(deps_key)s' % env) )
+    if state.built != '%s %s' % (state.tree, node_modules):
+        steps.append( ('build', 'sources or dependencies changed since the last build') )
+    code_changed = bool(steps)
+    
+    if env.target_data_dir not in state.dirs:
+        steps.append( ('make_directories_data', '%(target_data_dir)s is missing' % env) )
+    if not state.data[0]:
+        steps.append( ('clone_data', 'there is no data checkout') )
+    if state.data != [state.data_tip, 'refs/heads/' + env.git_data_branch]:
+        steps.append( ('update_data', 'data is at %s; %s is at %s' % (short(state.data[0]), env.git_data_branch, short(state.data_tip))) )
+    
+    if state.perms:
+        steps.append( ('fix_permissions', 'some files in %(target_dir)s are not %(owner)s:%(group)s and group-writable' % env) )
+    if state.perms_data:
+        steps.append( ('fix_permissions_data', 'some files in %(target_data_dir)s are not %(owner)s:%(group)s and group-writable' % env) )
+    
+    # After a release deploy, the live server runs its release rather than `target_dir`
+    if code_changed and not state.release:
+        steps.append( ('restart_server', 'the code changed') )
+    elif not state.running:
+        server = 'the live release of %(provider_job)s' if state.release else '%(provider_job)s'
+        steps.append( ('restart_server', (server + ' is not running') % env) )
+    return steps
+
+def print_plan(steps):
+    if not steps:
+        puts(cyan('%(host_string)s is up to date; nothing to do.' % env))
+        return
+    puts(white('Plan for %(host_string)s:' % env, bold=True))
+    for name, reason in steps:
+        puts('    %-22s %s' % (name, reason))
+
+def run_plan(steps):
+    "Runs the `plan_deploy()` steps in order, fixing permissions and restarting at most once each."
+    names = [ name for name, _ in steps ]
+    code = [ name for name in names if name in CODE_STEPS ]
+    changes = None
+    with restart_wave():
+        with deferred_permissions():
+            for name in names:
+                if name == 'update_data':
+                    changes = update_data('clone_data' in names)
+                else:
+                    PLAN_STEPS[name]()
+                # Requested as soon as the code is deployed, so the wave restarts it even if a later step fails
+                if code and name == code[-1] and 'restart_server' in names:
+                    restart_server()
+        if changes is not None:
+            publish_data(changes)
+
+def restart_server():
+    stop_server()
+    start_server()
+
+CODE_STEPS = ('make_directories', 'clone', 'update_branch', 'install_dependencies', 'build')
+
+PLAN_STEPS = {
+    'make_directories'      : make_directories,
+    'clone'                 : clone,
+    'update_branch'         : update_branch,
+    'install_dependencies'  : install_dependencies,
+    'build'                 : lambda: build_if_changed(force=True),
+    'make_directories_data' : make_directories_data,
+    'clone_data'            : clone_data,
+    'fix_permissions'       : fix_permissions,
+    'fix_permissions_data'  : fix_permissions_data,
+    'restart_server'        : restart_server,
+}
+
+
+
+
+
+### Release Deploys
+
+@task
+@expand_env
+@ensure_stage
+def release(build_locally=None):
+    """ Zero-downtime deploy: build into releases/<sha>, start it on the idle port, then cut over once healthy.
+    """
+    if build_locally is None:
+        build_locally = env.release_build_locally
+    release_ports() # check we can cut over before building anything
+    with deferred_permissions():
+        if truthy(build_locally):
+            sha = build_artifact()
+            ship_artifact(sha)
+        else:
+            sha = prepare_release()
+    activate_release(sha)
+    prune_releases()
+
+@msg('Preparing Release')
+def prepare_release():
+    """ Builds the branch head into `env.releases_dir`/<sha> (unless already built), returning the sha.
+        The live checkout and server are left untouched.
+    """
+    sha = local('git --git-dir=%s rev-parse %s' % (update_mirror(), env.git_branch), capture=True)
+    opts = dict(env, sha=sha, repo='%(releases_dir)s/.repo.git' % env, release='%s/%s' % (env.releases_dir, sha))
+    if exists(opts['release'], use_sudo=True):
+        puts(cyan('Release %(sha)s is already built.' % opts))
+        return sha
+    
+    sudo('[ -d %(repo)s ] || git clone --mirror --quiet %(git_origin)s %(repo)s' % opts)
+    sudo('git --git-dir=%(repo)s fetch --quiet --prune' % opts)
+    sudo('rm -rf %(release)s.tmp && git clone --quiet %(repo)s %(release)s.tmp' % opts)
+    with cd(opts['release'] + '.tmp'):
+        sudo('git checkout --quiet %(sha)s' % opts)
+        link_dependencies('.', ensure_dependencies(sha))
+        sudo('mkdir -p var && echo "{}" > var/config.json') # dummy placeholder config just to get coke build to work
+        with prefix('export PATH=$PATH:%(release)s.tmp/node_modules/.bin/' % opts):
+            sudo('coke build && coke bundle')
+    write_release_metadata(opts['release'] + '.tmp', sha)
+    # Only complete builds ever appear under their final name
+    sudo('mv -T %(release)s.tmp %(release)s' % opts)
+    _fix_permissions(env.releases_dir)
+    return sha
+
+@task
+@expand_env
+@ensure_stage
+@msg('Building Release Artifact')
+def build_artifact(rev=None):
+    """ Builds a release of `rev` (default: the branch head) locally into the artifact store, returning its sha.
+    """
+    mirror = update_mirror()
+    sha = local('git --git-dir=%s rev-parse %s' % (mirror, rev or env.git_branch), capture=True)
+    artifact = artifact_path(sha)
+    if artifact.exists():
+        puts(cyan('Release artifact for %s is already built.' % sha))
+        return sha
+    
+    build_dir = (env.local_tmp/'build'/sha).abspath()
+    build_dir.rmtree(ignore_errors=True)
+    local('git clone --quiet --shared %s %s' % (mirror, build_dir))
+    local_deps = install_dependencies_locally(stage_manifests(sha))
+    with lcd(build_dir):
+        local('git checkout --quiet %s' % sha)
+        local('ln -s %s/node_modules node_modules' % local_deps)
+        local('mkdir -p var && echo "{}" > var/config.json') # dummy placeholder config just to get coke build to work
+        with path(build_dir/'node_modules/.bin'):
+            local('coke build && coke bundle')
+    
+    # node_modules isn't shipped: hosts link their own copy from the dependency cache
+    artifact.parent.makedirs_p()
+    local('tar czf %s.tmp --exclude=./.git --exclude=./node_modules -C %s .' % (artifact, build_dir))
+    os.rename(artifact + '.tmp', artifact)
+    build_dir.rmtree()
+    prune_artifacts()
+    return sha
+
+def artifact_path(sha):
+    return env.artifacts_dir/sha + '.tar.gz'
+
+def prune_artifacts():
+    "Removes all but the newest `env.artifacts_keep` artifacts from the local store."
+    artifacts = sorted(env.artifacts_dir.files('*.tar.gz'), key=lambda f: f.mtime, reverse=True)
+    for artifact in artifacts[int(env.artifacts_keep):]:
+        artifact.remove()
+
+@msg('Shipping Release Artifact')
+def ship_artifact(sha):
+    """ Uploads the stored artifact for `sha` in one transfer and unpacks it into `env.releases_dir`/<sha>
+        on the host (unless it is already there).
+    """
+    release = '%s/%s' % (env.releases_dir, sha)
+    if exists(release, use_sudo=True):
+        puts(cyan('Release %s is already on the host.' % sha))
+        return
+    
+    upload = '/tmp/limn-release-%s.tar.gz' % sha
+    put(artifact_path(sha), upload)
+    with batch() as b:
+        b.sudo('rm -rf %s.tmp && mkdir -p %s.tmp' % (release, release))
+        b.sudo('tar xzf %s -C %s.tmp; status=$?; rm -f %s; exit $status' % (upload, release, upload))
+    link_dependencies(release + '.tmp', ensure_dependencies(sha))
+    write_release_metadata(release + '.tmp', sha)
+    # Only complete releases ever appear under their final name
+    sudo('mv -T %s.tmp %s' % (release, release))
+    _fix_permissions(env.releases_dir)
+
+@msg('Activating Release')
+def activate_release(sha):
+    """ Starts the release on the port not currently serving, waits for it to pass its health check,
+        flips `env.current_link` and the proxy over to it, then stops the previously live server.
+        
+        Each port's server is a job of the stage's provider (see `install_release_job()`), so the
+        live release is respawned if it dies and started again at boot.
+    """
+    ports = release_ports()
+    state = '%(releases_dir)s/.state/%(provider_job)s' % env
+    
+    sudo('mkdir -p %(releases_dir)s/.state && chown %(owner)s:%(group)s %(releases_dir)s/.state' % env)
+    live = sudo('cat %s.port 2>/dev/null || true' % state).strip()
+    port = ports[1] if live == str(ports[0]) else ports[0]
+    opts = dict(env, state=state, port=port, release='%s/%s' % (env.releases_dir, sha), slot='%s.%s' % (state, port),
+        stop='%s || true' % (PROVIDER_COMMANDS[env.provider]['stop'] % release_job(port)))
+    
+    # Clear out any candidate left on the port by an earlier attempt, then make sure nothing else
+    # (like the provider job's own server) holds it, or the candidate would die and the health
+    # check would pass against whatever is listening there
+    install_release_job(port)
+    sudo('rm -f %(slot)s.enabled; %(stop)s' % opts)
+    with settings(warn_only=True):
+        free = sudo('for i in $(seq 5); do %s || exit 0; sleep 1; done; exit 1' % port_bound_command(port)).succeeded
+    if not free:
+        abort(red('Port %s is already in use on the host! release_ports must not include the port %s serves on.'
+                  % (port, env.provider_job), bold=True))
+    
+    sudo('ln -sfn %(release)s %(slot)s.release.tmp && mv -Tf %(slot)s.release.tmp %(slot)s.release && touch %(slot)s.enabled' % opts)
+    control_server('start', env.provider, release_job(port))
+    if not wait_until_ready(port, release_job(port)):
+        sudo('rm -f %(slot)s.enabled; %(stop)s' % opts)
+        abort(red('Release %s failed its health check on port %s; the live server was left running. See %s.log' % (sha, port, opts['slot']), bold=True))
+    
+    sudo('ln -sfn %(release)s %(current_link)s.tmp && mv -Tf %(current_link)s.tmp %(current_link)s' % opts)
+    sudo('echo %(sha)s >> %(state)s.history' % dict(opts, sha=sha))
+    
+    sudo(env.proxy_switch_cmd.format(port=port))
+    sudo('echo %(port)s > %(state)s.port' % opts)
+    if live:
+        sudo('rm -f %s.%s.enabled; %s || true' % (state, live, PROVIDER_COMMANDS[env.provider]['stop'] % release_job(live)))
+    else:
+        # First release deploy: the old server is the one `provider_job` runs out of `target_dir`
+        control_server('stop', env.provider, env.provider_job)
+
+def release_job(port):
+    "Name of the provider job serving the stage's releases on `port`."
+    return env.release_job.format(port=port)
+
+RELEASE_JOB_DEFINITIONS = {
+    'supervisor' : """\
+; Release server of %(provider_job)s on port %(port)s, installed by limn-deploy
+[program:%(job)s]
+command=sh -c %(script)s
+user=%(owner)s
+autostart=true
+autorestart=unexpected
+exitcodes=0
+startsecs=0
+""",
+    'upstart'    : """\
+# Release server of %(provider_job)s on port %(port)s, installed by limn-deploy
+description "%(job)s"
+start on runlevel [2345]
+stop on runlevel [!2345]
+respawn
+normal exit 0
+setuid %(owner)s
+exec sh -c %(script)s
+""",
+}
+
+def install_release_job(port):
+    """ Installs (or updates) the provider's definition of the job serving releases on `port`.
+        
+        It runs whichever release `.state/<provider_job>.<port>.release` links to, as long as
+        `.state/<provider_job>.<port>.enabled` exists (only while that port is, or is about to be,
+        live); otherwise it exits at once. So when the host boots, only the live release comes up.
+    """
+    slot = '%s/.state/%s.%s' % (env.releases_dir, env.provider_job, port)
+    script = ('[ -e %(slot)s.enabled ] || exit 0; cd %(slot)s.release && export PATH=$PATH:%(slot)s.release/node_modules/.bin/ '
+              '&& exec %(cmd)s >> %(slot)s.log 2>&1' % dict(slot=slot, cmd=env.release_server_cmd.format(port=port)))
+    job = release_job(port)
+    definition = RELEASE_JOB_DEFINITIONS[env.provider] % dict(env, job=job, port=port, script=shell_quote(script))
+    commands = PROVIDER_COMMANDS[env.provider]
+    opts = dict(definition=shell_quote(definition), path=commands['job_file'] % job, reload=commands['reload'])
+    sudo('printf %%s %(definition)s > %(path)s.tmp && if cmp -s %(path)s.tmp %(path)s; then rm -f %(path)s.tmp; '
+         'else mv -f %(path)s.tmp %(path)s && %(reload)s; fi' % opts)
+
+def release_ports():
+    "The two ports release deploys alternate between, aborting unless they and `proxy_switch_cmd` are configured."
+    if not env.release_ports:
+        abort(red('Release deploys need the two ports to alternate between! Ex: --set release_ports=8091:8092', bold=True))
+    if not env.proxy_switch_cmd:
+        # Restarting the provider job instead would be neither zero-downtime nor (as it serves
+        # `target_dir`) running the new release
+        abort(red('Release deploys need a proxy_switch_cmd to cut the proxy over to the new release!', bold=True))
+    if env.provider not in RELEASE_JOB_DEFINITIONS:
+        abort(red('Release deploys run each release as a provider job, so need provider = %s!'
+                  % ' or '.join(sorted(RELEASE_JOB_DEFINITIONS)), bold=True))
+    return [ int(port) for port in str(env.release_ports).split(':') ]
+
+def port_bound_command(port):
+    "Shell test succeeding if something on the host is listening on `port`."
+    return "(ss -ltn 2>/dev/null || netstat -ltn 2>/dev/null) | awk '{ print $4 }' | grep -qE '[:.]%s$'" % port
+
+def wait_until_ready(port, job, timeout=None):
+    """ Polls the health check of the server on `port` on the host, returning whether it came up
+        in time; gives up as soon as the provider reports `job` has stopped or failed.
+    """
+    opts = dict(port=port, timeout=int(timeout or env.release_ready_timeout),
+        failed=PROVIDER_COMMANDS[env.provider]['failed'] % job, url=env.health_url.format(port=port))
+    with settings(warn_only=True):
+        return sudo('for i in $(seq %(timeout)s); do %(failed)s && exit 1; '
+                    'curl -sf -o /dev/null %(url)s && exit 0; sleep 1; done; exit 1' % opts).succeeded
+
+def write_release_metadata(release, sha):
+    "Records what was built into `release`: its sha, branch, stage, node_modules install and build time."
+    metadata = dict(sha=sha, branch=env.git_branch, stage=env.deploy_env, deps=env.deps_key,
+        built=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+    sudo('echo %s > %s/.release.json' % (shell_quote(json.dumps(metadata, sort_keys=True)), release))
+
+@task
+@expand_env
+@ensure_stage
+def releases():
+    """ Lists the releases retained on the host, marking the current one.
+    """
+    # The link is tagged, as a job that has never been released has none (and readlink prints nothing)
+    out = sudo('echo "current=$(readlink %(current_link)s)"; cat %(releases_dir)s/*/.release.json 2>/dev/null; true' % env)
+    lines = out.splitlines()
+    current = ''.join( line.strip()[len('current='):] for line in lines if line.startswith('current=') ).rsplit('/', 1)[-1]
+    found = sorted(( json.loads(line) for line in lines if line.startswith('{') ), key=lambda r: r['built'], reverse=True)
+    for r in found:
+        mark = green('* ', bold=True) if r['sha'] == current else '  '
+        puts('%s%s  %s  %-10s %-20s deps %s' % (mark, r['sha'][:10], r['built'], r['branch'], r['stage'], r['deps']), show_prefix=False)
+
+@task
+@expand_env
+@ensure_stage
+def rollback(sha=None):
+    """ Switches back to a retained release (default: the one active before the current one) without rebuilding.
+    """
+    if sha is None:
+        history = sudo('cat %(releases_dir)s/.state/%(provider_job)s.history 2>/dev/null; true' % env).split()
+        previous = [ h for h in history if h != history[-1] ]
+        if not previous:
+            abort(red('No previous release of %(provider_job)s to roll back to!' % env, bold=True))
+        sha = previous[-1]
+    
+    matches = [ m for m in sudo('ls -1d %s/%s* 2>/dev/null; true' % (env.releases_dir, sha)).split() if not m.endswith('.tmp') ]
+    if len(matches) != 1:
+        abort(red('%r matches %d releases retained on the host!' % (sha, len(matches)), bold=True))
+    sha = matches[0].rsplit('/', 1)[-1]
+    puts(cyan('Rolling back to %s.' % sha))
+    activate_release(sha)
+
+@msg('Pruning Old Releases')
+def prune_releases():
+    """ Removes all but the newest `env.releases_keep` releases. Releases live for any job sharing
+        `releases_dir` (per its `current-<job>` link or its history in .state) are always kept,
+        as are builds still in progress (<sha>.tmp).
+    """
+    # Only real directories, newest first: the `current-<job>` links point at directories too
+    sudo('cd %s && live=$(echo __none__; for link in current-*; do [ -L "$link" ] && basename "$(readlink "$link")"; done; '
+         'for h in .state/*.history; do [ -e "$h" ] && tail -n 1 "$h"; done); '
+         "find . -mindepth 1 -maxdepth 1 -type d ! -name '.*' ! -name '*.tmp' -printf '%%T@ %%P\\n' | sort -rn | cut -d' ' -f2- | "
+         'grep -vxF -e "$live" | tail -n +$((%s+1)) | xargs -r rm -rf'
+         % (env.releases_dir, int(env.releases_keep)))
+
+
+### Multi-Stage Deploys
+
+@task
+def all_stages(code=False, workers=None):
+    """ Deploy data (and optionally code) for every stage. Ex: `deploy.all_stages:code=yes`
+    """
+    stages(*STAGE_NAMES, code=code, workers=workers)
+
+@task
+def stages(*names, **kwargs):
+    """ Deploy several stages at once. Ex: `deploy.stages:reportcard,gp,flow[,code=yes][,workers=4]`
+        
+        Stages can also be selected by what they share: `host=`, `job=` (provider job) or `target_dir=`.
+        Steps that depend only on the code checkout (clone, dependencies, build, bundle) run once
+        per distinct (hosts, target_dir, git_branch); the per-stage data steps then fan out over a
+        bounded pool of threads sharing each host's connection.
+    """
+    code    = truthy(kwargs.get('code', False))
+    workers = int(kwargs.get('workers') or env.stage_workers)
+    names   = list(names)
+    for selector, key in (('host', 'hosts'), ('job', 'provider_job'), ('target_dir', 'target_dir')):
+        if selector in kwargs:
+            names += [ name for name in STAGE_TABLE.where(key, kwargs[selector]) if name not in names ]
+    if not names:
+        abort(red('You must name at least one stage! Ex: deploy.stages:reportcard,gp', bold=True))
+    
+    envs = [ stage_env(name) for name in names ]
+    
+    # Restarts are held until the data is deployed too, then run once per job
+    with restart_wave():
+        if code:
+            for group in _group_by(envs, lambda e: (tuple(e.hosts), e.target_dir, e.git_branch)):
+                env.update(group[0])
+                puts(cyan('Deploying code for %s' % ', '.join(_stage_names(group)), bold=True))
+                execute(_shared_code_steps, group, hosts=group[0].hosts)
+        
+        hosts = sorted(set( host for e in envs for host in e.hosts ))
+        for host in hosts:
+            # Stages writing to the same var dir link into one tree, so each such group runs serially
+            units = _group_by([ e for e in envs if host in e.hosts ], lambda e: e.target_var_dir)
+            with settings(host_string=host):
+                with quietly('Connecting to %s' % host):
+                    sudo('true') # opens the shared connection and caches the sudo password up front
+                pmap(_deploy_data_unit, [ _StageUnit(unit) for unit in units ], workers)
+
+def _shared_code_steps(group):
+    with deferred_permissions():
+        make_directories()
+        clone()
+        update_branch()
+        install_dependencies()
+        
+        build_if_changed()
+    
+    # Every stage's server runs the shared code; the enclosing restart wave restarts each job once
+    for e in group:
+        with settings(provider=e.provider, provider_job=e.provider_job):
+            stop_server()
+            start_server()
+
+def _deploy_data_unit(unit):
+    for e in unit:
+        puts(green('[%s] Updating data...' % e.stage_name, bold=True))
+        sudo(_data_script(e))
+        puts(white('[%s] Woo.' % e.stage_name))
+
+class _StageUnit(list):
+    "A list of stage envs deployed serially by one worker."
+    def __str__(self):
+        return '+'.join(_stage_names(self))
+
+def _data_script(e):
+    """ Shell script performing `make_directories_data`, `clone_data`, `update_branch_data`,
+        `sync_data_links` and `publish_data` for the stage env `e`.
+        
+        Runs in `pmap()` workers, so touches no global state (see there).
+    """
+    opts = dict(e, previous=PREVIOUS_DATA_REF, links=data_links_script(e),
+        clone=data_clone_command(e), update='\n'.join(data_update_commands(e)), gc=data_gc_command(e) or 'true',
+        reload=('curl -sf -X POST --data-binary @- %s' % shell_quote(data_reload_url(e))) if e.data_reload_url else 'cat >/dev/null')
+    return '''set -e
+mkdir -p %(target_data_dir)s
+cloned=
+[ -d %(target_data_dir)s/.git ] || { %(clone)s; cloned=1; }
+cd %(target_data_dir)s
+git update-ref %(previous)s HEAD
+%(update)s
+changes=$(git diff --no-renames --name-status %(previous)s HEAD)
+%(gc)s
+full=$cloned
+%(links)s
+[ -z "$changes" ] || git diff --no-renames --name-only %(previous)s HEAD | %(reload)s''' % opts
 
+def _group_by(envs, key):
+    "Groups stage envs by `key(env)`, preserving the order in which keys are first seen."
+    groups = {}
+    order  = []
+    for e in envs:
+        k = key(e)
+        if k not in groups:
+            groups[k] = []
+            order.append(k)
+        groups[k].append(e)
+    return [ groups[k] for k in order ]
 
+def _stage_names(envs):
+    return [ e.stage_name for e in envs ]
@@ -1,49 +1,47 @@
-import sys
 import socket
+import threading
 
-import getpass
 import paramiko as ssh
-from paramiko.resource import ResourceManager
 
 from fabric import network
 from fabric import state as s
 
 def connect_forward(gw, host, port, user):
     """
-    Create a different connect that works with a gateway. We really need to
-    create the socket and destroy it when the connection fails and then retry
-    the connect.
+    Connects to `host` through the gateway, over a channel from `gw` (a GatewayPool).
+    If authentication fails, prompts for a password and retries on a fresh channel.
     """
-    client = ForwardSSHClient()
+    client = ssh.SSHClient()
+    # Load known host keys (e.g. ~/.ssh/known_hosts) unless user says not to.
+    if not s.env.disable_known_hosts:
+        client.load_system_host_keys()
+    # Unless user specified not to, accept/add new, unknown host keys
+    if not s.env.reject_unknown_hosts:
+        client.set_missing_host_key_policy(ssh.AutoAddPolicy())
+    
     while True:
-        # Load known host keys (e.g. ~/.ssh/known_hosts) unless user says not to.
-        if not s.env.disable_known_hosts:
-            client.load_system_host_keys()
-        # Unless user specified not to, accept/add new, unknown host keys
-        if not s.env.reject_unknown_hosts:
-            client.set_missing_host_key_policy(ssh.AutoAddPolicy())
-        
-        sock = gw.get_transport().open_channel('direct-tcpip', (host, int(port)), ('', 0))
+        sock = gw.open_channel(host, port)
         try:
-            client.connect(host, sock, int(port), user, s.env.password,
-                           key_filename=s.env.key_filename, timeout=10)
-            client._sock_ = sock
+            client.connect(host, int(port), user, s.env.password, sock=sock,
+                           key_filename=s.env.key_filename, timeout=10,
+                           allow_agent=not s.env.no_agent, look_for_keys=not s.env.no_keys)
+            client.get_transport().set_keepalive(gw.keepalive)
             return client
         except (
             ssh.AuthenticationException,
             ssh.PasswordRequiredException,
             ssh.SSHException
         ), e:
-            if e.__class__ is ssh.SSHException and password:
+            sock.close()
+            if isinstance(e, ssh.BadHostKeyException) or (e.__class__ is ssh.SSHException and s.env.password):
                 network.abort(str(e))
             
             s.env.password = network.prompt_for_password(s.env.password)
-            sock.close()
         
-        except (EOFError, TypeError):
-            # Print a newline (in case user was sitting at prompt)
+        except EOFError:
+            # Print a newline (the user hit ^D at the password prompt)
             print('')
-            sys.exit(0)
+            network.abort('Cancelled connecting to %s' % host)
         # Handle timeouts
         except socket.timeout:
             network.abort('Timed out trying to connect to %s' % host)
@@ -57,71 +55,103 @@ def connect_forward(gw, host, port, user):
                 host, e[1])
             )
 
-class ForwardSSHClient(ssh.SSHClient):
+class GatewayPool(object):
     """
-    Override the default ssh.SSHClient to make it accept a socket as an extra argument,
-    instead of creating one of its own.
+    Authenticated connections to the gateway, shared by every host and thread.
+    
+    Keepalives are set on each transport, and connections that have died (ex: the
+    bastion dropped them while idle) are transparently replaced. Channels are opened
+    round-robin over `size` connections; paramiko transports are themselves safe to
+    open channels on from several threads at once.
+    
+    If `env.gateway_control_path` is set, channels are instead tunnelled through
+    `ssh -W` over an OpenSSH ControlMaster socket at that path, which persists
+    (see `env.gateway_control_persist`) so successive `fab` runs reuse one
+    authenticated bastion session.
     """
-    def connect(self, hostname, sock, port=22, username=None, password=None, pkey=None,
-                key_filename=None, timeout=None, allow_agent=True, look_for_keys=True):
-        t = self._transport = ssh.Transport(sock)
-        
-        if self._log_channel is not None:
-            t.set_log_channel(self._log_channel)
-        
-        t.start_client()
-        ResourceManager.register(self, t)
-        
-        server_key = t.get_remote_server_key()
-        keytype = server_key.get_name()
-        
-        our_server_key = self._system_host_keys.get(hostname, {}).get(keytype, None)
-        if our_server_key is None:
-            our_server_key = self._host_keys.get(hostname, {}).get(keytype, None)
-        if our_server_key is None:
-            # will raise exception if the key is rejected; let that fall out
-            self._policy.missing_host_key(self, hostname, server_key)
-            # if the callback returns, assume the key is ok
-            our_server_key = server_key
-        
-        if server_key != our_server_key:
-            raise ssh.BadHostKeyException(hostname, server_key, our_server_key)
-        
-        if username is None:
-            username = getpass.getuser()
-        
-        if key_filename is None:
-            key_filenames = []
-        elif isinstance(key_filename, (str, unicode)):
-            key_filenames = [ key_filename ]
-        else:
-            key_filenames = key_filename
-        self._auth(username, password, pkey, key_filenames, allow_agent, look_for_keys)
+    def __init__(self, gateway, size=1, keepalive=30, control_path=None, control_persist='10m'):
+        self.gateway = gateway
+        self.size = max(1, int(size))
+        self.keepalive = int(keepalive)
+        self.control_path = control_path
+        self.control_persist = control_persist
+        self._clients = []
+        self._next = 0
+        self._lock = threading.RLock()
+    
+    def open_channel(self, host, port):
+        if self.control_path:
+            return self._proxy_command(host, port)
+        client = self._client()
+        try:
+            return client.get_transport().open_channel('direct-tcpip', (host, int(port)), ('', 0))
+        except (ssh.SSHException, EOFError, socket.error):
+            # The transport died since we last checked it; retry once on a fresh one
+            self._discard(client)
+            return self._client().get_transport().open_channel('direct-tcpip', (host, int(port)), ('', 0))
+    
+    def _client(self):
+        with self._lock:
+            self._clients = [ c for c in self._clients if is_alive(c) ]
+            if len(self._clients) < self.size:
+                gw_user, gw_host, gw_port = network.normalize(self.gateway)
+                client = network.connect(gw_user, gw_host, gw_port, None, False)
+                client.get_transport().set_keepalive(self.keepalive)
+                self._clients.append(client)
+                return client
+            self._next = (self._next + 1) % len(self._clients)
+            return self._clients[self._next]
+    
+    def _discard(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        client.close()
+    
+    def _proxy_command(self, host, port):
+        return ssh.ProxyCommand(' '.join([
+            'ssh', '-o', 'ControlMaster=auto',
+                   '-o', 'ControlPath=%s' % self.control_path,
+                   '-o', 'ControlPersist=%s' % self.control_persist,
+                   '-o', 'ServerAliveInterval=%s' % self.keepalive,
+                   '-W', '%s:%s' % (host, port), self.gateway,
+        ]))
+
+def is_alive(client):
+    "Whether the client's transport is still connected."
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
 
 class GatewayConnectionCache(network.HostConnectionCache):
     _gw = None
+    _lock = threading.RLock()
+    
     def __getitem__(self, key):
         gw = s.env.get('gateway')
         if gw is None:
             return super(GatewayConnectionCache, self).__getitem__(key)
         
-        gw_user, gw_host, gw_port = network.normalize(gw)
-        if self._gw is None:
+        with self._lock:
+            if self._gw is None or self._gw.gateway != gw:
+                self._gw = GatewayPool(gw,
+                    size=s.env.get('gateway_pool_size', 1),
+                    keepalive=s.env.get('gateway_keepalive', 30),
+                    control_path=s.env.get('gateway_control_path'),
+                    control_persist=s.env.get('gateway_control_persist', '10m'))
+            
             # Normalize given key (i.e. obtain username and port, if not given)
-            self._gw = network.connect(gw_user, gw_host, gw_port, None, False)
-        
-        # Normalize given key (i.e. obtain username and port, if not given)
-        user, host, port = network.normalize(key)
-        # Recombine for use as a key.
-        real_key = network.join_host_strings(user, host, port)
-        
-        # If not found, create new connection and store it
-        if real_key not in self:
-            self[real_key] = connect_forward(self._gw, host, port, user)
-        
-        # Return the value either way
-        return dict.__getitem__(self, real_key)
+            user, host, port = network.normalize(key)
+            # Recombine for use as a key.
+            real_key = network.join_host_strings(user, host, port)
+            
+            # If not found (or the connection died), create new connection and store it
+            if real_key not in self or not is_alive(dict.__getitem__(self, real_key)):
+                self[real_key] = connect_forward(self._gw, host, port, user)
+            
+            # Return the value either way
+            return dict.__getitem__(self, real_key)
 
+# Modules that bound `connections` at import need pointing at the new cache too
 _c = s.connections = GatewayConnectionCache()
-from fabric import operations
-operations.connections = _c
+from fabric import operations, sftp, context_managers
+operations.connections = sftp.connections = context_managers.connections = _c
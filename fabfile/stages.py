@@ -3,41 +3,122 @@
 "Setup Staging Environments"
 
 import sys
+from os.path import dirname, join
+from ConfigParser import RawConfigParser
 from functools import wraps
 from fabric.api import env, abort, prompt, execute, task
 from fabric.colors import white, blue, cyan, green, yellow, red, magenta
 from fabric.contrib.console import confirm
-from util import InvalidChoice
+from fabric.utils import _AttributeDict
+from util import InvalidChoice, env_expander
 
 
 __all__ = [
-    'STAGES', 'STAGE_NAMES', 'prompt_for_stage', 'ensure_stage', 'list_stages',
-    'working_branch', 'check_branch',
+    'STAGES', 'STAGE_NAMES', 'STAGE_TABLE', 'prompt_for_stage', 'ensure_stage', 'list_stages',
+    'working_branch', 'check_branch', 'stage_env',
 ]
 
 
 STAGES = {}
 STAGE_NAMES = []
+STAGES_FILE = join(dirname(__file__), 'stages.ini')
 
 def stage(fn):
     """ Decorator indicating this function sets a stage environment.
     """
     STAGES[fn.__name__] = fn
     STAGE_NAMES.append(fn.__name__)
+    globals()[fn.__name__] = fn
     __all__.append(fn.__name__)
     return fn
 
+
+class StageTable(object):
+    """ The stages declared in `stages.ini`, compiled into their `env` settings and
+        indexed by the settings that decide which deploy work stages can share:
+        
+            STAGE_TABLE.where('provider_job', 'limn-gp')    # => ['gp', 'gp_zero', 'gp_geowiki']
+            STAGE_TABLE.sharing('example', 'target_var_dir') # => ['debugging', 'example']
+    """
+    INDEXED = ('hosts', 'gateway', 'target_dir', 'target_var_dir', 'git_branch', 'provider_job')
+    
+    def __init__(self, stages):
+        self.names    = [ name for name, _ in stages ]
+        self.settings = dict(stages)
+        self.index    = dict( (key, {}) for key in self.INDEXED )
+        for name, settings in stages:
+            for key in self.INDEXED:
+                values = settings.get(key)
+                for value in (values if isinstance(values, list) else [values]):
+                    self.index[key].setdefault(value, []).append(name)
+    
+    @classmethod
+    def load(cls, filename):
+        "Reads the stages from an INI file, where each section inherits the settings in [DEFAULT]."
+        config = RawConfigParser()
+        if not config.read(filename):
+            raise IOError('Unable to read stages from %r!' % filename)
+        stages = []
+        for name in config.sections():
+            settings = dict(config.items(name))
+            settings.setdefault('deploy_env', name)
+            settings['hosts'] = [ host.strip() for host in settings['hosts'].split(',') if host.strip() ]
+            stages.append( (name, settings) )
+        return cls(stages)
+    
+    def where(self, key, value):
+        "Names of the stages whose `key` setting is (or, for lists like `hosts`, includes) `value`."
+        return list(self.index[key].get(value, []))
+    
+    def sharing(self, name, key):
+        "Names of the stages with the same `key` setting as stage `name` (including itself)."
+        values = self.settings[name].get(key)
+        names = set()
+        for value in (values if isinstance(values, list) else [values]):
+            names.update(self.where(key, value))
+        return [ n for n in self.names if n in names ]
+    
+    def stage_fn(self, name):
+        "A function applying the stage's settings to `env`, named and documented after it."
+        settings = dict(self.settings[name])
+        doc = settings.pop('doc', name)
+        def set_stage():
+            env.update(settings)
+            env.hosts = list(settings['hosts'])
+        set_stage.__name__ = name
+        set_stage.__doc__  = ' %s\n    ' % doc
+        return set_stage
+
 def validate_stage(name):
     """ Tests whether given name is a valid staging environment.
         
             name = fabric.api.prompt(msg, validate=validate_stage)
     """
     name = name.strip()
-    if name not in STAGE_NAMES:
+    if name not in STAGES:
         raise InvalidChoice("%r is not a valid staging environment!" % name)
     return name
 
 
+def stage_env(name):
+    """ Returns a copy of `env` as the named stage would configure it (with all
+        strings expanded), leaving the current `env` untouched.
+    """
+    name = validate_stage(name)
+    saved = env.copy()
+    expander = env_expander.fork()
+    try:
+        STAGES[name]()
+        expander.refresh()
+        snapshot = _AttributeDict(env)
+        snapshot.hosts = list(snapshot.hosts)
+        snapshot.stage_name = name # several stages share a `deploy_env`
+        return snapshot
+    finally:
+        env.clear()
+        env.update(saved)
+
+
 def prompt_for_stage(fn):
     "Decorator which prompts for a stage-name if not set."
     
@@ -84,8 +165,8 @@ def list_stages():
     "List deployment enviornments."
     print "Stages:\n"
     maxlen = max(map(len, STAGE_NAMES))
-    for name, stage in STAGES.iteritems():
-        print '    %s  %s' % (name.ljust(maxlen), stage.__doc__.strip())
+    for name in STAGE_NAMES:
+        print '    %s  %s' % (name.ljust(maxlen), STAGES[name].__doc__.strip())
 
 # (otto) There should be a way to do this using stages.
 # See: http://tav.espians.com/fabric-python-with-cleaner-api-and-parallel-deployment-support.html
@@ -100,299 +181,7 @@ def list_stages():
 # from importing them.
 ###
 
-@stage
-def reportcard():
-    """ reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'reportcard'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/reportcard'
-    env.target_data_dir = '/var/lib/limn/reportcard/data-repository'
-    env.target_data_to  = 'rc'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/reportcard/data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-reportcard'
-    env.provider        = 'upstart'
-
-
-@stage
-def test_reportcard():
-    """ test-reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'test_reportcard'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/test-reportcard'
-    env.target_data_dir = '/var/lib/limn/test-reportcard/data-repository'
-    env.target_data_to  = 'rc'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/reportcard/data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-test-reportcard'
-    env.provider        = 'upstart'
-
-@stage
-def gp():
-    """ gp.wmflabs.org
-    """
-    env.deploy_env      = 'gp'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/gp'
-    env.target_data_dir = '/var/lib/limn/gp/gp-data-repository'
-    env.target_data_to  = 'gp'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/global-dev/dashboard-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-gp'
-    env.provider        = 'upstart'
-
-
-@stage
-def gp_zero():
-    """ gp.wmflabs.org (wp-zero data)
-    """
-    env.deploy_env      = 'gp'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/gp'
-    env.target_data_dir = '/var/lib/limn/gp/gp-zero-data-repository'
-    env.target_data_to  = 'gp_zero'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/analytics/wp-zero/data'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-gp'
-    env.provider        = 'upstart'
-
-@stage
-def gp_geowiki():
-    """ gp.wmflabs.org (wp-zero data)
-    """
-    env.deploy_env      = 'gp'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/gp'
-    env.target_data_dir = '/var/lib/limn/gp/gp-geowiki-data-repository'
-    env.target_data_to  = 'gp_geowiki'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/analytics/geowiki/data-public'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-gp'
-    env.provider        = 'upstart'
-
-
-@stage
-def mobile_reportcard():
-    """ mobile-reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'mobile_reportcard'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/mobile-reportcard'
-    env.target_data_dir = '/var/lib/limn/mobile-reportcard/data-repository'
-    env.target_data_to  = 'mobile'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/limn-mobile-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-mobile-reportcard'
-    env.provider        = 'upstart'
-
-
-@stage
-def flow():
-    """ flow-reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'flow'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/flow-reportcard'
-    env.target_data_dir = '/var/lib/limn/flow-reportcard/data-repository'
-    env.target_data_to  = 'flow'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/limn-flow-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-flow-reportcard'
-    env.provider        = 'upstart'
-
-
-@stage
-def ee_dashboard():
-    """ ee-dashboard.wmflabs.org
-    """
-    env.deploy_env      = 'ee_dashboard'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/ee-dashboard'
-    env.target_data_dir = '/var/lib/limn/ee-dashboard/data-repository'
-    env.target_data_to  = 'eee'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://github.com/wikimedia/limn-editor-engagement-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-ee-dashboard'
-    env.provider        = 'upstart'
-
-
-@stage
-def debugging():
-    """ debugging.wmflabs.org
-    """
-    env.deploy_env      = 'debugging'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/debugging'
-    env.target_data_dir = '/var/lib/limn/debugging/data-repository'
-    env.target_data_to  = 'debugging'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://github.com/wikimedia/limn-debugging-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-debugging'
-    env.provider        = 'upstart'
-
-
-@stage
-def example():
-    """ debugging.wmflabs.org/dashboards/sample
-    """
-    env.deploy_env      = 'debugging'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/debugging'
-    env.target_data_dir = '/var/lib/limn/example/data-repository'
-    env.target_data_to  = 'example'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://github.com/wikimedia/limn-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-debugging'
-    env.provider        = 'upstart'
-
+STAGE_TABLE = StageTable.load(STAGES_FILE)
 
-@stage
-def multimedia():
-    """ multimedia-metrics.wmflabs.org
-    """
-    env.deploy_env      = 'multimedia_metrics'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/multimedia-metrics'
-    env.target_data_dir = '/var/lib/limn/multimedia-metrics/data-repository'
-    env.target_data_to  = 'multimedia'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/analytics/multimedia/config'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-multimedia-metrics'
-    env.provider        = 'upstart'
-
-
-@stage
-def glam():
-    """ multimedia-metrics.wmflabs.org
-    """
-    env.deploy_env      = 'glam_metrics'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/glam-metrics'
-    env.target_data_dir = '/var/lib/limn/glam-metrics/data-repository'
-    env.target_data_to  = 'glam'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://github.com/Commonists/limn-glam.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-glam-metrics'
-    env.provider        = 'upstart'
-
-
-@stage
-def edit():
-    """ edit-reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'edit'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/edit-reportcard'
-    env.target_data_dir = '/var/lib/limn/edit-reportcard/data-repository'
-    env.target_data_to  = 'edit'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/limn-edit-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-edit-reportcard'
-    env.provider        = 'upstart'
-
-
-@stage
-def language():
-    """ language-reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'language'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/language-reportcard'
-    env.target_data_dir = '/var/lib/limn/language-reportcard/data-repository'
-    env.target_data_to  = 'language'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/limn-language-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-language-reportcard'
-    env.provider        = 'upstart'
-
-
-@stage
-def extdist():
-    """ extdist-reportcard.wmflabs.org
-    """
-    env.deploy_env      = 'extdist'
-    env.hosts           = ['limn1.eqiad.wmflabs']
-    env.gateway         = 'bastion-eqiad.wmflabs.org'
-    env.target_dir      = '/usr/local/share/limn'
-    env.target_var_dir  = '/var/lib/limn/extdist-reportcard'
-    env.target_data_dir = '/var/lib/limn/extdist-reportcard/data-repository'
-    env.target_data_to  = 'extdist'
-    env.git_branch      = 'develop'
-    env.git_data_origin = 'https://gerrit.wikimedia.org/r/p/analytics/limn-extdist-data.git'
-    env.git_data_branch = 'master'
-    env.owner           = 'limn'
-    env.group           = 'limn'
-    env.provider_job    = 'limn-extdist-reportcard'
-    env.provider        = 'upstart'
+for _name in STAGE_TABLE.names:
+    stage(STAGE_TABLE.stage_fn(_name))
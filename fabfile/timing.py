@@ -0,0 +1,249 @@
+#!/usr/bin/env fab
+# -*- coding: utf-8 -*-
+"Deploy Step Timings"
+
+import atexit, json, os, sys, threading, time
+from contextlib import contextmanager
+
+from paramiko import Channel
+from paramiko.packet import Packetizer
+from fabric import operations, sftp, tasks
+from fabric.api import env, puts
+from fabric.colors import white, cyan
+
+
+# Every task run through `execute()` (and every `msg()`-wrapped step) is timed: its wall time, how much
+# of that went on remote commands and transfers, the traffic over Fabric's own SSH connections and
+# how many remote commands it ran. When fab exits, a breakdown by self time is printed and the steps
+# are saved as JSON to `env.timings_dir` (plus a chrome://tracing file with `env.timings_trace`).
+# Importing this module installs the hooks.
+
+_started = time.time()
+_lock    = threading.Lock()
+_local   = threading.local()
+_steps   = []         # finished steps, in the order they finished
+_traffic = [0, 0]     # bytes sent, received over SSH
+
+
+class Step(object):
+    "One timed invocation of a task or step. Totals include nested steps; see `self_*()` for what doesn't."
+
+    def __init__(self, name, label, parent):
+        self.name, self.label, self.parent = name, label, parent
+        self.thread   = threading.current_thread()
+        self.start    = time.time()
+        self.end      = None
+        self.traffic  = sum(_traffic)
+        self.remote   = 0.0
+        self.commands = 0
+        self.children = dict(wall=0.0, remote=0.0, bytes=0, commands=0)
+
+    @property
+    def wall(self):
+        return (self.end or time.time()) - self.start
+
+    def finish(self):
+        self.end     = time.time()
+        self.traffic = sum(_traffic) - self.traffic
+        with _lock:
+            _steps.append(self)
+            if self.parent:
+                kids = self.parent.children
+                kids['wall']     += self.wall
+                kids['remote']   += self.remote
+                kids['bytes']    += self.traffic
+                kids['commands'] += self.commands
+
+    # Steps fanned out over threads can overlap, so their children can add up to more than they took.
+    def self_wall(self):     return max(0.0, self.wall - self.children['wall'])
+    def self_remote(self):   return max(0.0, self.remote - self.children['remote'])
+    def self_bytes(self):    return max(0, self.traffic - self.children['bytes'])
+    def self_commands(self): return self.commands - self.children['commands']
+
+    def to_dict(self):
+        return dict(name=self.name, label=self.label, thread=self.thread.name,
+            parent=self.parent and self.parent.name, start=self.start - _started, wall=self.wall,
+            remote=self.remote, local=self.wall - self.remote, bytes=self.traffic, commands=self.commands,
+            self_wall=self.self_wall(), self_remote=self.self_remote(), self_bytes=self.self_bytes(),
+            self_commands=self.self_commands())
+
+
+### Recording
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def context():
+    "The calling thread's open steps, for handing to worker threads (see `adopted()`)."
+    return list(_stack())
+
+@contextmanager
+def adopted(steps):
+    "Attributes work done by this (worker) thread inside the block to `steps`, taken from `context()`."
+    saved, _local.stack = _stack(), list(steps)
+    try:
+        yield
+    finally:
+        _local.stack = saved
+
+@contextmanager
+def step(name, label=None):
+    """ Times the block as step `name`. A step directly inside another of the same name
+        (ie, the `msg()` of a task) just labels that one rather than nesting.
+    """
+    stack = _stack()
+    if stack and stack[-1].name == name:
+        if label:
+            stack[-1].label = label
+        yield stack[-1]
+        return
+
+    s = Step(name, label or name, stack[-1] if stack else None)
+    stack.append(s)
+    try:
+        yield s
+    finally:
+        stack.pop()
+        s.finish()
+
+def _waited(elapsed, commands=0):
+    "Charges time spent waiting on the host to every open step."
+    with _lock:
+        for s in _stack():
+            s.remote   += elapsed
+            s.commands += commands
+
+
+### Hooks
+
+def _timed(fn, commands=0):
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _waited(time.time() - start, commands)
+    timed.__name__ = fn.__name__
+    timed.__doc__  = fn.__doc__
+    return timed
+
+# `run()` and `sudo()` both go through `_run_command`; uploads and downloads through the SFTP wrapper
+operations._run_command = _timed(operations._run_command, commands=1)
+sftp.SFTP.put = _timed(sftp.SFTP.put)
+sftp.SFTP.get = _timed(sftp.SFTP.get)
+
+_execute_task = tasks.WrappedCallableTask.run
+def _run_task(self, *args, **kwargs):
+    with step(self.name):
+        return _execute_task(self, *args, **kwargs)
+tasks.WrappedCallableTask.run = _run_task
+
+# Count traffic on the connections that actually hit the wire: a host reached through the gateway
+# has a transport tunnelled over a channel of the gateway's, which already counts those bytes.
+# (rsync and the other ssh subprocesses `local()` runs aren't seen at all.)
+def _on_wire(packetizer):
+    return not isinstance(getattr(packetizer, '_Packetizer__socket', None), Channel)
+
+_write_all = Packetizer.write_all
+def _counted_write_all(self, out):
+    if _on_wire(self):
+        with _lock:
+            _traffic[0] += len(out)
+    return _write_all(self, out)
+Packetizer.write_all = _counted_write_all
+
+_read_all = Packetizer.read_all
+def _counted_read_all(self, n, *args, **kwargs):
+    out = _read_all(self, n, *args, **kwargs)
+    if _on_wire(self):
+        with _lock:
+            _traffic[1] += len(out)
+    return out
+Packetizer.read_all = _counted_read_all
+
+
+### Reporting
+
+def summary():
+    "Steps aggregated by name, slowest (by self time) first."
+    by_name = {}
+    for s in _steps:
+        agg = by_name.setdefault(s.name, dict(name=s.name, label=s.label, calls=0, wall=0.0,
+            self_wall=0.0, remote=0.0, local=0.0, bytes=0, commands=0))
+        agg['calls']     += 1
+        agg['wall']      += s.wall
+        agg['self_wall'] += s.self_wall()
+        agg['remote']    += s.self_remote()
+        agg['local']     += max(0.0, s.self_wall() - s.self_remote())
+        agg['bytes']     += s.self_bytes()
+        agg['commands']  += s.self_commands()
+    return sorted(by_name.values(), key=lambda agg: agg['self_wall'], reverse=True)
+
+def human_bytes(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return '%d%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fGB' % n
+
+def print_report(rows):
+    puts(white('\nTimings (seconds, excluding nested steps):', bold=True))
+    puts(cyan('  %-34s %5s %8s %8s %8s %8s %5s %8s' %
+        ('step', 'calls', 'total', 'self', 'remote', 'local', 'cmds', 'ssh*')))
+    for r in rows:
+        puts('  %-34s %5d %8.2f %8.2f %8.2f %8.2f %5d %8s' % (r['label'][:34], r['calls'], r['wall'],
+            r['self_wall'], r['remote'], r['local'], r['commands'], human_bytes(r['bytes'])))
+    puts('  %-34s %5s %8.2f' % ('(whole run)', '', time.time() - _started))
+    puts("  * Fabric's own SSH traffic only: rsync, tar | ssh and other `local()` transfers aren't counted")
+
+def chrome_trace():
+    "The steps as Chrome trace events (complete events, in microseconds)."
+    events = []
+    for thread in set( s.thread for s in _steps ):
+        events.append(dict(ph='M', name='thread_name', pid=1, tid=thread.ident, args=dict(name=thread.name)))
+    for s in _steps:
+        d = s.to_dict()
+        events.append(dict(ph='X', name=s.label, cat=s.name, pid=1, tid=s.thread.ident,
+            ts=int(d['start'] * 1e6), dur=int(s.wall * 1e6),
+            args=dict( (k, d[k]) for k in ('remote', 'local', 'bytes', 'commands') )))
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+def write_reports(rows):
+    "Writes this run's timings to `env.timings_dir`, returning the JSON file's path."
+    dirname = str(env.timings_dir) % env
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(_started))
+    run = dict(started=_started, wall=time.time() - _started, argv=sys.argv,
+        ssh_sent=_traffic[0], ssh_received=_traffic[1], ssh_excludes='subprocesses (rsync, tar | ssh)',
+        summary=rows, steps=[ s.to_dict() for s in _steps ])
+
+    filename = os.path.join(dirname, stamp + '.json')
+    with open(filename, 'w') as f:
+        json.dump(run, f, indent=2)
+    if _enabled('timings_trace'):
+        with open(os.path.join(dirname, stamp + '.trace.json'), 'w') as f:
+            json.dump(chrome_trace(), f)
+    return filename
+
+def _enabled(key):
+    "Whether setting `key` is on, reading '0', 'no' etc from the commandline as off."
+    from util import truthy # not at the top: util imports this module
+    return truthy(env.get(key))
+
+@atexit.register
+def report():
+    if not _steps:
+        return
+    rows = summary()
+    if _enabled('timings_report'):
+        print_report(rows)
+    if str(env.get('timings_dir') or '').strip():
+        try:
+            filename = write_reports(rows)
+            if _enabled('timings_report'):
+                puts('  (written to %s)\n' % filename)
+        except (IOError, OSError), e:
+            puts('Could not write timings: %s' % e)
@@ -2,23 +2,32 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import with_statement
+import subprocess, base64, re, sys, threading, uuid
 from contextlib import contextmanager
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 from path import path as p # renamed to avoid conflict w/ fabric.api.path
 
 from fabric.api import *
 from fabric.colors import white, blue, cyan, green, yellow, red, magenta
+from fabric.context_managers import char_buffered
+
+import timing
 
 __all__ = (
-    'InvalidChoice',
-    'quietly', 'msg', 'branches', 'working_branch', 'coke', 'update_version',
-    'defaults', 'expand', 'expand_env', 'format', 'expand_env',
+    'InvalidChoice', 'ExpansionCycle',
+    'quietly', 'batch', 'msg', 'branches', 'working_branch', 'update_mirror', 'mirror_show', 'mirror_rev',
+    'coke', 'update_version',
+    'defaults', 'expand', 'expand_env', 'env_expander', 'format', 'expand_env', 'truthy', 'pmap', 'shell_quote',
     'validate_command', 'get_commands',
 )
 
 class InvalidChoice(Exception):
     "Exception thrown when user makes an invalid choice in a prompt."
 
+class ExpansionCycle(Exception):
+    "Exception thrown when `env` settings refer to one another in a loop."
+
 
 ### Context Managers
 
@@ -29,14 +38,129 @@ def quietly(txt):
     with hide('everything'): yield
     puts("woo.", show_prefix=False, flush=True)
 
+@contextmanager
+def batch(warn_only=False):
+    """ Queues the `run()`/`sudo()` calls made on the yielded `RemoteBatch`, then ships them
+        to the host as one script (honouring any enclosing `cd()`/`prefix()`) when the block exits:
+        
+            with batch() as b:
+                b.sudo('mkdir -p /srv/x', unless='test -d /srv/x')
+                pull = b.sudo('git pull')
+            print b[pull].return_code, b[pull]
+        
+        Commands run in order; after the first failure the rest are skipped, and (unless
+        `warn_only`) the task aborts.
+    """
+    b = RemoteBatch()
+    yield b
+    b.execute(warn_only=warn_only)
+
+
+class BatchResult(str):
+    """ Output of one command in a `RemoteBatch`, with `return_code`, `succeeded`, `failed`
+        and `skipped` (because of its guard, or an earlier failure) attributes.
+    """
+    def __new__(cls, command, output='', return_code=None):
+        result = str.__new__(cls, output)
+        result.command = command
+        result.return_code = return_code
+        return result
+    
+    skipped   = property(lambda self: self.return_code is None)
+    succeeded = property(lambda self: self.return_code == 0)
+    failed    = property(lambda self: self.return_code not in (0, None))
+
+
+class RemoteBatch(object):
+    "Remote commands queued by `batch()`."
+    
+    def __init__(self):
+        self.token    = uuid.uuid4().hex
+        self.commands = [] # (command, use_sudo, only_if, unless)
+        self.results  = []
+    
+    def run(self, command, only_if=None, unless=None):
+        """ Queues `command` to be run as the connecting user, only if the shell test
+            `only_if` succeeds and/or `unless` fails.
+        """
+        return self._queue(command, False, only_if, unless)
+    
+    def sudo(self, command, only_if=None, unless=None):
+        "Queues `command` to be run as root; see `run()`."
+        return self._queue(command, True, only_if, unless)
+    
+    def _queue(self, command, use_sudo, only_if, unless):
+        self.commands.append( (command, use_sudo, only_if, unless) )
+        return len(self.commands) - 1
+    
+    def script(self):
+        "The bash script running each queued command and reporting its output and exit code."
+        use_sudo = any( cmd[1] for cmd in self.commands )
+        lines = []
+        for i, (command, cmd_sudo, only_if, unless) in enumerate(self.commands):
+            if use_sudo and not cmd_sudo:
+                command = 'sudo -u "$SUDO_USER" -H bash -c %s' % shell_quote(command)
+            guards = []
+            if only_if: guards.append('(%s)' % only_if)
+            if unless:  guards.append('! (%s)' % unless)
+            lines.append("echo '@@%s:%d:start'" % (self.token, i))
+            lines.append('if %s; then (%s) 2>&1; rc=$?; else rc=-; fi' % (' && '.join(guards) or 'true', command))
+            lines.append("echo; echo \"@@%s:%d:$rc\"" % (self.token, i))
+            lines.append('[ "$rc" = 0 -o "$rc" = - ] || exit 0')
+        return '\n'.join(lines) + '\n'
+    
+    def execute(self, warn_only=False):
+        """ Ships the queued commands in one round-trip, returning a list of `BatchResult`s
+            (which also replace the indices returned by `run()`/`sudo()` in `self.results`).
+        """
+        if not self.commands:
+            return self.results
+        use_sudo = any( cmd[1] for cmd in self.commands )
+        shipped  = 'echo %s | base64 -d | bash' % base64.b64encode(self.script())
+        with hide('running', 'stdout'):
+            out = (sudo if use_sudo else run)(shipped)
+        
+        outputs, codes, current = {}, {}, None
+        for line in out.replace('\r', '').split('\n'):
+            if line.startswith('@@%s:' % self.token):
+                _, i, status = line.split(':')
+                if status == 'start':
+                    current = int(i)
+                    outputs[current] = []
+                else:
+                    codes[int(i)] = None if status == '-' else int(status)
+                    current = None
+            elif current is not None:
+                outputs[current].append(line)
+        
+        self.results = []
+        for i, (command, cmd_sudo, _, _) in enumerate(self.commands):
+            result = BatchResult(command, '\n'.join(outputs.get(i, [])).strip(), codes.get(i))
+            self.results.append(result)
+            if result.skipped:
+                continue
+            puts('%s: %s' % ('sudo' if cmd_sudo else 'run', command))
+            if result:
+                puts(result)
+            if result.failed and not warn_only:
+                abort('Batched command %r failed with exit code %s:\n%s' % (command, result.return_code, result))
+        return self.results
+    
+    def __getitem__(self, i):
+        return self.results[i]
+
 
 ### Decorators
 
 def msg(txt, quiet=False):
-    "Decorator to wrap a task in a message, optionally suppressing all output."
+    "Decorator to wrap a task in a message, optionally suppressing all output. The step is timed (see `timing`)."
     def outer(fn):
         @wraps(fn)
         def inner(*args, **kwargs):
+            with timing.step(fn.__name__, txt):
+                return announce(*args, **kwargs)
+        
+        def announce(*args, **kwargs):
             if quiet:
                 puts(green(txt + '...', bold=True), end='', flush=True)
                 with hide('everything'):
@@ -66,6 +190,40 @@ def working_branch():
     "Determines the working branch."
     return [ branch.split()[1] for branch in local('git branch --no-color', capture=True).split('\n') if '*' in branch ][0]
 
+_fetched_mirrors = set()
+
+def update_mirror():
+    """ Creates or incrementally fetches (at most once per run) the local bare mirror
+        of `env.git_origin`, returning its path.
+    """
+    mirror = p(env.git_mirror)
+    if mirror not in _fetched_mirrors:
+        if not (mirror/'HEAD').exists():
+            mirror.parent.makedirs_p()
+            local('git clone --mirror --quiet %s %s' % (env.git_origin, mirror))
+        else:
+            local('git --git-dir=%s fetch --prune --quiet' % mirror)
+        _fetched_mirrors.add(mirror)
+    return mirror
+
+def mirror_show(rev, filepath):
+    "Contents of `filepath` at `rev` in the local mirror, or None if it doesn't exist there."
+    proc = subprocess.Popen(['git', '--git-dir=%s' % update_mirror(), 'show', '%s:%s' % (rev, filepath)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return out
+
+def mirror_rev(rev):
+    "The object name `rev` resolves to in the local mirror, or None if it doesn't resolve."
+    proc = subprocess.Popen(['git', '--git-dir=%s' % update_mirror(), 'rev-parse', '-q', '--verify', rev],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return out.strip()
+
 
 
 ### Coke Integration
@@ -86,6 +244,10 @@ def update_version():
 
 ### Misc
 
+def shell_quote(s):
+    "Quotes `s` as a single shell word."
+    return "'" + s.replace("'", "'\\''") + "'"
+
 def defaults(target, *sources):
     "Update target dict using `setdefault()` for each key in each source."
     for source in sources:
@@ -94,13 +256,9 @@ def defaults(target, *sources):
     return target
 
 def expand(s):
-    "Recursively expands given string using the `env` dict."
-    is_path = isinstance(s, p)
-    prev = None
-    while prev != s:
-        prev = s
-        s = s % env
-    return p(s) if is_path else s
+    "Expands `%(key)s` references in given string using the (expanded) `env` dict."
+    env_expander.refresh()
+    return type(s)(s % env)
 
 def format(s):
     "Recursively formats string using the `env` dict."
@@ -112,23 +270,144 @@ def format(s):
     return p(s) if is_path else s
 
 
-@runs_once
-def _expand_env():
-    for k, v in env.iteritems():
-        if not isinstance(v, basestring): continue
-        env[k] = expand(env[k])
+class EnvExpander(object):
+    """ Expands the `%(key)s` references between the settings of `target` (a dict like `env`),
+        keeping each setting's template so that when a setting changes -- say, a different
+        stage's `target_dir` -- only the settings that depend on it are expanded again.
+        
+        References are resolved depth-first, so each template is expanded once, in one pass.
+        Templates referring to settings that aren't set are left as they are until they are.
+    """
+    REFERENCE = re.compile(r'%\((\w+)\)')
+    
+    def __init__(self, target):
+        self.target    = target
+        self.templates = {} # key -> template, for settings with references
+        self.refs      = {} # key -> keys its template refers to
+        self.seen      = {} # key -> the value last seen or written there
+        self.lock      = threading.RLock()
+    
+    def fork(self):
+        "A copy that can expand a changed `target` (ex: while trying out a stage) without affecting this one."
+        other = EnvExpander(self.target)
+        other.templates, other.refs, other.seen = dict(self.templates), dict(self.refs), dict(self.seen)
+        return other
+    
+    def refresh(self):
+        "Expands the templates depending on settings changed since the last refresh, returning their keys."
+        with self.lock:
+            changed = self.changes()
+            if not changed:
+                return set()
+            
+            dirty, grew = set(changed), True
+            while grew:
+                more = set( k for k, refs in self.refs.iteritems() if k not in dirty and refs & dirty )
+                dirty |= more
+                grew = bool(more)
+            
+            expanded = set()
+            for k in sorted(dirty):
+                self.resolve(k, dirty, expanded, [])
+            return expanded
+    
+    def changes(self):
+        "Keys set, replaced or removed since they were last seen, recording the new templates among them."
+        changed = set()
+        for k, v in self.target.iteritems():
+            if k in self.seen and self.seen[k] is v:
+                continue
+            changed.add(k)
+            self.seen[k] = v
+            if isinstance(v, basestring) and '%(' in v:
+                self.templates[k] = v
+                self.refs[k] = set(self.REFERENCE.findall(v))
+            else:
+                self.templates.pop(k, None)
+                self.refs.pop(k, None)
+        for k in set(self.seen) - set(self.target):
+            changed.add(k)
+            del self.seen[k]
+            self.templates.pop(k, None)
+            self.refs.pop(k, None)
+        return changed
+    
+    def resolve(self, k, dirty, expanded, stack):
+        if k in expanded or k not in dirty or k not in self.templates:
+            return
+        if k in stack:
+            raise ExpansionCycle('Settings refer to each other: %s' % ' -> '.join(stack[stack.index(k):] + [k]))
+        stack.append(k)
+        for ref in self.refs[k]:
+            self.resolve(ref, dirty, expanded, stack)
+        stack.pop()
+        
+        # Settings referring to one only some tasks have (like a stage's `target_dir`), directly
+        # or through another template, are left unexpanded
+        template = self.templates[k]
+        if any( ref not in self.target or self.target[ref] is self.templates.get(ref) for ref in self.refs[k] ):
+            value = template
+        else:
+            value = type(template)(template % self.target)
+        self.target[k] = self.seen[k] = value
+        expanded.add(k)
+
+env_expander = EnvExpander(env)
 
 def expand_env(fn):
-    "Decorator expands all strings in `env`."
+    "Decorator expands all strings in `env` (those whose references changed since the last time, anyway)."
     
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        _expand_env()
+        env_expander.refresh()
         return fn(*args, **kwargs)
     
     return wrapper
 
 
+def truthy(v):
+    "Interprets a task argument (always a string from the commandline) as a boolean."
+    if isinstance(v, basestring):
+        return v.strip().lower() in ('1', 'y', 'yes', 'true', 'on')
+    return bool(v)
+
+def pmap(fn, items, workers=4):
+    """ Maps `fn` over `items` using a bounded pool of threads, returning the results in order.
+        
+        Threads (rather than Fabric's forked @parallel) let every worker share the one cached
+        connection to a host. Fabric's `abort()` raises `SystemExit`, which would silently kill a
+        pool thread, so each worker catches it; once every job has finished, the caller `abort()`s
+        (raising `SystemExit` itself) naming the jobs that failed. Other exceptions propagate as usual.
+        
+        As the workers share Fabric's global `env` and output settings, `fn` must leave them alone:
+        no `cd()`, `lcd()`, `prefix()`, `settings()`, `hide()` or `quiet=`. Put the directory or
+        options in the command itself.
+    """
+    steps = timing.context()
+    def call(item):
+        try:
+            with timing.adopted(steps):
+                return True, fn(item)
+        except SystemExit, e:
+            return False, e
+    
+    # Each remote command puts the terminal into cbreak mode and restores it after. Entering it here
+    # first means every overlapping command saves (and restores) that same state, and only this
+    # thread puts back the user's own, once they have all finished.
+    pool = ThreadPool(max(1, min(int(workers), len(items) or 1)))
+    try:
+        with char_buffered(sys.stdin):
+            outcomes = pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+    
+    failed = [ item for item, (ok, _) in zip(items, outcomes) if not ok ]
+    if failed:
+        abort('%d of %d jobs failed: %s' % (len(failed), len(items), ', '.join(map(str, failed))))
+    return [ result for _, result in outcomes ]
+
+
 def validate_command(cmd):
     """ Tests whether a command-name is valid:
         
@@ -22,10 +22,11 @@ setup(
     maintainer_email = 'dandreescu@wikimedia.org',
     
     packages         = find_packages(),
+    package_data     = { 'fabfile' : ['stages.ini'] },
     
     install_requires = [
         "pycrypto",
-        "paramiko>=0.15.2",
+        "paramiko>=1.10",
         "Fabric",
         "path.py",
     ],